@@ -0,0 +1,20 @@
+'''
+Normalized acquisition key for ASTER granules, eg AST_L1B_00305012019220000.
+The version and acquisition date appear with and without an underscore
+between them in producer granule ids; the key drops it, so granules can be
+looked up with an exact term instead of a leading wildcard.
+'''
+
+import re
+
+VERSION_ACQUISITION_DATE = re.compile(r'(?<!\d)(\d{3})_?(\d{14})(?!\d)')
+KEY = '{}_{}{}' # short_name, version, acquisition date
+
+def acquisition_key(short_name, granule_id):
+    '''returns the acquisition key of a producer granule id or lp daac file name, or None if it has no acquisition date'''
+    if not short_name or not granule_id:
+        return None
+    match = VERSION_ACQUISITION_DATE.search(granule_id)
+    if match is None:
+        return None
+    return KEY.format(short_name, match.group(1), match.group(2))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+'''
+Aggregates the scrape_report.json counts and missing LP DAAC ID csvs of the
+ingest_ava_met shard jobs submitted by a fan out run into one report.
+'''
+
+from __future__ import print_function
+import os
+import csv
+import json
+import argparse
+import requests
+import urllib3
+from es_client import mozart
+
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+REPORT_FILE = 'scrape_report.json'
+COUNTS = ["total_granules", "ingested_granules", "non_ingested_granules"]
+HEADER = ["missing_lp_daac_id_products", "ava_product_url"]
+
+
+def main(run_tag, dirs, output_dir):
+    '''collects the shard reports from mozart (by run tag) and/or local directories and writes the combined report'''
+    sources = list(dirs or [])
+    if run_tag:
+        sources.extend(query_job_urls(run_tag))
+    if not sources:
+        raise Exception('no shard jobs or directories to aggregate')
+    session = requests.Session()
+    totals = dict((k, 0) for k in COUNTS)
+    shards = []
+    missing_rows = []
+    for source in sources:
+        report = load_json(session, source, REPORT_FILE)
+        if report is None:
+            print('no report found for shard: {}'.format(source))
+            shards.append({"source": source, "complete": False})
+            continue
+        for k in COUNTS:
+            totals[k] += int(report.get(k) or 0)
+        shards.append(dict(report, source=source, complete=True))
+        missing_rows.extend(load_csv(session, source, report.get("missing_csv")))
+    report = dict(totals, run_tag=run_tag, shards=shards)
+    with open(os.path.join(output_dir, REPORT_FILE), 'w') as outf:
+        json.dump(report, outf, indent=2)
+    with open(os.path.join(output_dir, 'missing_lp_daac_id_products.csv'), 'w') as outf:
+        writer = csv.DictWriter(outf, fieldnames=HEADER)
+        writer.writeheader()
+        writer.writerows(missing_rows)
+    print('{} granules ingested, {} NOT ingested out of {} across {} shards ({} without a report)'.format(
+        totals["ingested_granules"], totals["non_ingested_granules"], totals["total_granules"],
+        len(shards), len([s for s in shards if not s["complete"]])))
+
+
+def query_job_urls(run_tag):
+    '''returns the work directory urls of the shard jobs tagged with run_tag'''
+    idx = "job_status-current"
+    es_query = {"query": {"bool": {"must": [{"query_string": {"default_field": "tags", "query": '"{}"'.format(run_tag)}}]}},
+                "_source": ["job.job_info.job_url", "status"], "from": 0, "size": 10000}
+    hits = mozart().hits(idx, es_query)
+    urls = []
+    for hit in hits:
+        job_url = hit['_source'].get('job', {}).get('job_info', {}).get('job_url')
+        if job_url:
+            urls.append(job_url)
+        else:
+            print('job {} has no work directory url (status: {})'.format(hit['_id'], hit['_source'].get('status')))
+    return urls
+
+
+def read_file(session, source, filename):
+    '''reads filename from a local directory or a job work directory url. returns None if it is missing'''
+    if source.startswith('http://') or source.startswith('https://'):
+        response = session.get('{}/{}'.format(source.rstrip('/'), filename), verify=False, timeout=60)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.text
+    path = os.path.join(source, filename)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as fin:
+        return fin.read()
+
+
+def load_json(session, source, filename):
+    '''loads a json file from a shard'''
+    text = read_file(session, source, filename)
+    return json.loads(text) if text is not None else None
+
+
+def load_csv(session, source, filename):
+    '''loads the rows of a missing LP DAAC ID csv from a shard'''
+    text = read_file(session, source, filename) if filename else None
+    if not text:
+        return []
+    return list(csv.DictReader(text.splitlines()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-t', '--run_tag', help='Run tag of the fan out, eg "ingest_ava_met-AST_L1B-2000_2018"',
+                        dest='run_tag', required=False)
+    parser.add_argument('-d', '--dir', help='Shard work directory (local path or url). May be repeated',
+                        dest='dirs', action='append', required=False)
+    parser.add_argument('-o', '--output_dir', help='Directory to write the combined report to',
+                        dest='output_dir', required=False, default='.')
+    args = parser.parse_args()
+    main(args.run_tag, args.dirs, args.output_dir)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+'''
+Backfills metadata.acquisition_key on existing GRQ products (eg MET-AST_L1B in
+grq_v1.0_metadata-ast_l1b) so they can be found by exact key lookups instead
+of producer_granule_id wildcards.
+'''
+
+from __future__ import print_function
+import argparse
+import urllib3
+from acquisition_key import acquisition_key
+from es_client import grq
+
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+SCROLL_SIZE = 1000
+MISSING_QUERY = {"query": {"bool": {"must_not": [{"exists": {"field": "metadata.acquisition_key"}}]}},
+                 "_source": ["metadata.producer_granule_id", "metadata.short_name"], "size": SCROLL_SIZE}
+
+
+def main(indices, dry_run=False):
+    '''scrolls through the products of each index missing an acquisition key and updates them in bulk'''
+    for idx in indices:
+        updated = skipped = 0
+        print('{}: scrolling through the products without an acquisition key'.format(idx))
+        for hits in grq().scroll(idx, MISSING_QUERY, keep_alive='5m'):
+            actions = []
+            for hit in hits:
+                metadata = hit.get('_source', {}).get('metadata', {})
+                key = acquisition_key(metadata.get('short_name'), metadata.get('producer_granule_id'))
+                if key is None:
+                    skipped += 1
+                    continue
+                action = {"_index": hit['_index'], "_id": hit['_id']}
+                if '_type' in hit:
+                    action["_type"] = hit['_type']
+                actions.append((action, {"doc": {"metadata": {"acquisition_key": key}}}))
+            if actions and not dry_run:
+                bulk_update(actions)
+            updated += len(actions)
+        print('{}: {} products {}updated, {} without a producer_granule_id acquisition date'.format(
+            idx, updated, 'would be ' if dry_run else '', skipped))
+
+
+def bulk_update(actions):
+    '''sends the (action, doc) update pairs as one _bulk request. raises if any update failed'''
+    lines = []
+    for action, doc in actions:
+        lines.extend([{"update": action}, doc])
+    results = grq().bulk(lines)
+    if results.get('errors'):
+        failed = [item['update'] for item in results.get('items', []) if item.get('update', {}).get('error')]
+        raise Exception('{} of {} updates failed, eg: {}'.format(len(failed), len(actions), failed[:1]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-i', '--index', help='Index to backfill, eg "grq_v1.0_metadata-ast_l1b". May be repeated',
+                        dest='indices', action='append', required=True)
+    parser.add_argument('-n', '--dry_run', help='Only count the products that would be updated',
+                        dest='dry_run', action='store_true')
+    args = parser.parse_args()
+    main(args.indices, args.dry_run)
@@ -0,0 +1,81 @@
+'''
+Browse image generation for the product localizers. Decodes the source image
+once with Pillow and writes both browse.png and browse_small.png from the same
+decoded image, falling back to ImageMagick convert when Pillow is unavailable.
+'''
+
+from __future__ import print_function
+import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+try:
+    from PIL import Image
+    RESAMPLE = getattr(Image, 'Resampling', Image).BILINEAR
+except ImportError:
+    Image = None
+
+BROWSE_SIZE = (300, 300)
+BROWSE_WORKERS = 4
+
+
+def browse_paths(prod_id):
+    '''returns the browse and small browse paths of a product'''
+    browse_path = os.path.join(prod_id, '{}.browse.png'.format(prod_id))
+    browse_small_path = os.path.join(prod_id, '{}.browse_small.png'.format(prod_id))
+    return browse_path, browse_small_path
+
+
+def generate_browse(product_path, prod_id):
+    '''attempts to generate browse if it doesn't already exist'''
+    browse_path, browse_small_path = browse_paths(prod_id)
+    if os.path.exists(browse_path):
+        return
+    if Image is not None:
+        render_browse(product_path, browse_path, browse_small_path)
+    else:
+        convert_browse(product_path, browse_path, browse_small_path)
+    os.remove(product_path)
+
+
+def render_browse(product_path, browse_path, browse_small_path):
+    '''decodes product_path once and writes the full size and the small png browse from it'''
+    image = Image.open(product_path)
+    try:
+        image.load()
+        if image.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+            # e.g. 16 bit or cmyk tifs
+            image = image.convert('RGB')
+        image.save(browse_path, 'PNG')
+        small = image.copy()
+        small.thumbnail(BROWSE_SIZE, RESAMPLE)
+        small.save(browse_small_path, 'PNG')
+    finally:
+        image.close()
+
+
+def convert_browse(product_path, browse_path, browse_small_path):
+    '''generates the browse images with imagemagick'''
+    #conver to png
+    subprocess.call(['convert', product_path, browse_path])
+    #convert to small png
+    subprocess.call(['convert', product_path, '-resize', '{}x{}'.format(*BROWSE_SIZE), browse_small_path])
+
+
+def generate_browses(browses, workers=BROWSE_WORKERS):
+    '''generates browse for a batch of (product_path, prod_id) in a process pool. returns the prod_ids that failed'''
+    failed = []
+    # one source image per product, as generate_browse keeps the first browse made
+    sources = {}
+    for product_path, prod_id in browses:
+        sources.setdefault(prod_id, product_path)
+    if not sources:
+        return failed
+    with ProcessPoolExecutor(max_workers=min(workers, len(sources))) as executor:
+        futures = [(executor.submit(generate_browse, product_path, prod_id), prod_id) for prod_id, product_path in sources.items()]
+        for future, prod_id in futures:
+            try:
+                future.result()
+            except Exception as e:
+                print('unable to generate browse for {}: {}'.format(prod_id, e))
+                failed.append(prod_id)
+    return failed
@@ -0,0 +1,542 @@
+'''
+Shared in-process HTTP downloader for the localizers: pooled keep-alive
+sessions, chunked streaming writes, .netrc auth that survives redirects
+(e.g. through Earthdata Login), resumable range requests with backoff,
+multi-connection segmented downloads, integrity checks and throughput
+metrics.
+'''
+
+from __future__ import print_function
+import os
+import re
+import time
+import random
+import netrc
+import json
+import hashlib
+import threading
+import logging as logger
+from contextlib import contextmanager
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from requests.utils import get_netrc_auth
+try:
+    from urllib.parse import urlparse, urljoin
+    from html.parser import HTMLParser
+except ImportError:
+    from urlparse import urlparse, urljoin
+    from HTMLParser import HTMLParser
+
+BUFFER_SIZE = 1024 * 1024 # bytes read from the socket per write
+POOL_SIZE = 10
+TIMEOUT = 60
+PROGRESS_INTERVAL = 100 * 1024 * 1024 # log progress every 100MB
+ATTEMPTS = 10
+BACKOFF_BASE = 2.0 # seconds
+BACKOFF_CAP = 120.0
+RETRY_CLIENT_STATUS = (408, 429) # the client errors worth retrying, along with 5xx
+PART_SUFFIX = '.part'
+SIZE_TOLERANCE = 0.01 # relative tolerance for the CMR granule_size, which is rounded
+SEGMENT_MIN_SIZE = 8 * 1024 * 1024 # smallest byte range worth its own connection
+CONTENT_RANGE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+|\*)')
+SIZE = re.compile(r'^\s*([\d.]+)\s*([KMGT]?)B?\s*$', re.IGNORECASE) # eg the job spec disk_usage, "10GB"
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+GUARD_POLL_INTERVAL = 5 # seconds between disk usage checks while throttled
+
+_stats = {"files": 0, "bytes": 0, "seconds": 0.0}
+_stats_lock = threading.Lock()
+
+
+class DownloadError(IOError):
+    '''raised when a download fails or does not pass its integrity checks'''
+
+
+class IntegrityError(DownloadError):
+    '''raised when a downloaded file does not match its expected length, size or checksum'''
+
+
+class NetrcSession(requests.Session):
+    '''requests session that authenticates every request, including redirects to other hosts, from a .netrc file'''
+    def __init__(self, netrc_file=None, buffer_size=BUFFER_SIZE, segments=None):
+        super(NetrcSession, self).__init__()
+        self.netrc_file = netrc_file
+        self.buffer_size = buffer_size
+        self.segments = segments or {}
+        self.auth = self._netrc_auth
+        self._netrc = None
+
+    def _netrc_auth(self, request):
+        '''requests auth hook adding basic auth for the request host, if .netrc has credentials for it'''
+        credentials = self.credentials(request.url)
+        if credentials:
+            return HTTPBasicAuth(*credentials)(request)
+        return request
+
+    def credentials(self, url):
+        '''returns the (login, password) for the url host, or None'''
+        if self.netrc_file is None:
+            # default .netrc locations, as requests would use them
+            return get_netrc_auth(url)
+        if self._netrc is None:
+            self._netrc = netrc.netrc(self.netrc_file)
+        auth = self._netrc.authenticators(urlparse(url).hostname)
+        if auth:
+            return auth[0], auth[2]
+        return None
+
+    def rebuild_auth(self, prepared_request, response):
+        '''drops credentials when redirected to another host, then adds the .netrc credentials for the new host'''
+        super(NetrcSession, self).rebuild_auth(prepared_request, response)
+        self._netrc_auth(prepared_request)
+
+
+def get_session(pool_size=POOL_SIZE, buffer_size=BUFFER_SIZE, netrc_file=None, segments=None):
+    '''
+    returns a download session with a keep-alive connection pool of pool_size. segments maps a host (or
+    "default") to the number of parallel byte range connections used per file from that host
+    '''
+    session = NetrcSession(netrc_file=netrc_file, buffer_size=buffer_size, segments=segments)
+    pool_size = max([pool_size] + [int(n) for n in session.segments.values()])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def download(url, path, session=None, verify=False, timeout=TIMEOUT, attempts=ATTEMPTS, size_mb=None, checksum=None,
+             keep_partial=False):
+    '''
+    streams url to path in session.buffer_size chunks. data is written to path.part and resumed with range
+    requests after dropped connections, retrying with exponential backoff and jitter. the file is only moved
+    to path once it matches the server length and, when given, the CMR size_mb and checksum
+    ({"algorithm": "MD5", "value": "..."}). a file failing those checks is fetched once more before giving up.
+    path.part is removed when the download fails, unless keep_partial. returns the number of bytes in the file
+    '''
+    if session is None:
+        session = get_session(pool_size=1)
+    part_path = path + PART_SUFFIX
+    start = time.time()
+    try:
+        fetch_verified(session, url, part_path, verify, timeout, attempts, size_mb, checksum)
+    except Exception:
+        # never leave a partial file behind for the product to be published with
+        if not keep_partial and os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    return finish(part_path, path, start)
+
+
+def fetch_verified(session, url, part_path, verify, timeout, attempts, size_mb, checksum):
+    '''downloads url into part_path, over segments when configured, until it passes verify_file. raises DownloadError'''
+    validator = None
+    # a mismatch against the expected size or checksum is likely to repeat, so it only gets one more fetch
+    refetched = False
+    segments = segments_for(session, url)
+    if size_mb and float(size_mb) * 1024 * 1024 < 2 * SEGMENT_MIN_SIZE:
+        # too small to split, so not worth a HEAD request
+        segments = 1
+    if segments > 1:
+        probe = probe_ranges(session, url, verify, timeout)
+        if probe is None:
+            logger.info('{} does not advertise byte ranges, using a single stream'.format(url))
+        else:
+            total, validator = probe
+            segments = min(segments, max(1, total // SEGMENT_MIN_SIZE))
+            if segments > 1:
+                try:
+                    fetch_segmented(session, url, part_path, total, validator, segments, verify, timeout, attempts)
+                    verify_file(part_path, total, size_mb, checksum)
+                    return
+                except DownloadError as e:
+                    logger.warning('segmented download of {} failed ({}), falling back to a single stream'.format(url, e))
+                    refetched = isinstance(e, IntegrityError)
+                    validator = None
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+    attempt = 0
+    while True:
+        try:
+            total, validator = fetch(session, url, part_path, verify, timeout, validator)
+            verify_file(part_path, total, size_mb, checksum)
+            return
+        except IntegrityError as e:
+            if refetched:
+                raise
+            refetched = True
+            error = e
+            validator = None
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        except DownloadError as e:
+            # a corrupt or inconsistent partial file can't be resumed
+            error = e
+            validator = None
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        except (requests.exceptions.RequestException, IOError) as e:
+            if not retryable(e):
+                raise DownloadError('unable to download {}: {}'.format(url, e))
+            error = e
+        attempt += 1
+        if attempt >= attempts:
+            raise DownloadError('unable to download {} after {} attempts: {}'.format(url, attempts, error))
+        delay = backoff(attempt)
+        logger.warning('download of {} failed ({}), retrying in {:.1f}s'.format(url, error, delay))
+        time.sleep(delay)
+
+
+def finish(part_path, path, start):
+    '''moves a verified partial file into place and records it. returns the number of bytes in the file'''
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(part_path, path)
+    written = os.path.getsize(path)
+    record(path, written, time.time() - start)
+    return written
+
+
+def parse_segments(value):
+    '''parses a per host segments setting from a context param, given as a dict or a json string'''
+    if not value:
+        return {}
+    if not isinstance(value, dict):
+        value = json.loads(value)
+    return dict((host, int(n)) for host, n in value.items())
+
+
+def segments_for(session, url):
+    '''returns the number of parallel segments configured for the url host'''
+    segments = getattr(session, 'segments', None) or {}
+    host = urlparse(url).hostname
+    return int(segments.get(host, segments.get('default', 1)))
+
+
+def probe_ranges(session, url, verify, timeout):
+    '''returns (length, validator) if the server advertises byte ranges for url, otherwise None'''
+    try:
+        response = session.head(url, verify=verify, timeout=timeout, allow_redirects=True)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        logger.warning('unable to probe {}: {}'.format(url, e))
+        return None
+    length = response.headers.get('Content-Length', '')
+    if response.headers.get('Accept-Ranges', '').lower() != 'bytes' or not length.isdigit():
+        return None
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return int(length), etag
+    return int(length), response.headers.get('Last-Modified')
+
+
+def fetch_segmented(session, url, part_path, total, validator, segments, verify, timeout, attempts):
+    '''downloads url into a preallocated part_path as segments byte ranges fetched in parallel'''
+    bounds = [total * i // segments for i in range(segments + 1)]
+    ranges = [(bounds[i], bounds[i + 1] - 1) for i in range(segments)]
+    logger.info('downloading {} in {} segments'.format(url, segments))
+    with open(part_path, 'wb') as outf:
+        outf.truncate(total)
+    fd = os.open(part_path, os.O_WRONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=segments) as executor:
+            futures = [executor.submit(fetch_segment, session, url, fd, first, last, validator, verify, timeout, attempts)
+                       for first, last in ranges]
+            for future in futures:
+                future.result()
+    finally:
+        os.close(fd)
+
+
+def fetch_segment(session, url, fd, first, last, validator, verify, timeout, attempts):
+    '''fetches bytes first..last of url into the file descriptor at the same offsets, resuming the range on errors'''
+    position = first
+    attempt = 0
+    while position <= last:
+        headers = {'Range': 'bytes={}-{}'.format(position, last)}
+        if validator:
+            headers['If-Range'] = validator
+        try:
+            response = session.get(url, stream=True, verify=verify, timeout=timeout, headers=headers)
+            try:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    # the file changed or the server ignored the range
+                    raise DownloadError('{} did not honour range {}-{}'.format(url, position, last))
+                for chunk in response.iter_content(chunk_size=session.buffer_size):
+                    chunk = chunk[:last + 1 - position]
+                    pwrite(fd, chunk, position)
+                    position += len(chunk)
+                    if position > last:
+                        break
+            finally:
+                response.close()
+            if position <= last:
+                raise IOError('connection closed at byte {} of range {}-{}'.format(position, first, last))
+        except DownloadError:
+            raise
+        except (requests.exceptions.RequestException, IOError) as e:
+            if not retryable(e):
+                raise DownloadError('unable to download range {}-{} of {}: {}'.format(first, last, url, e))
+            attempt += 1
+            if attempt >= attempts:
+                raise DownloadError('unable to download range {}-{} of {} after {} attempts: {}'.format(first, last, url, attempts, e))
+            delay = backoff(attempt)
+            logger.warning('range {}-{} of {} failed at byte {} ({}), retrying in {:.1f}s'.format(first, last, url, position, e, delay))
+            time.sleep(delay)
+
+
+_pwrite_lock = threading.Lock()
+
+def pwrite(fd, data, offset):
+    '''writes data at offset without moving a shared file position'''
+    if hasattr(os, 'pwrite'):
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+        return
+    with _pwrite_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        os.write(fd, data)
+
+
+def fetch(session, url, part_path, verify, timeout, validator=None):
+    '''
+    downloads url into part_path, continuing from the end of an existing partial file when the server honours
+    the range request. returns the total length reported by the server (or None) and the validator (ETag or
+    Last-Modified) to resume against
+    '''
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {}
+    if offset:
+        headers['Range'] = 'bytes={}-'.format(offset)
+        if validator:
+            headers['If-Range'] = validator
+    response = session.get(url, stream=True, verify=verify, timeout=timeout, headers=headers)
+    try:
+        if response.status_code == 416 and offset:
+            # nothing left to fetch if the partial file is already complete
+            total = response.headers.get('Content-Range', '').split('/')[-1]
+            if total.isdigit() and int(total) == offset:
+                return offset, validator
+            raise DownloadError('server rejected the range request for {}'.format(url))
+        response.raise_for_status()
+        etag = response.headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            validator = etag
+        else:
+            validator = response.headers.get('Last-Modified')
+        if response.status_code == 206:
+            match = CONTENT_RANGE.match(response.headers.get('Content-Range', ''))
+            if not match or int(match.group(1)) != offset:
+                raise DownloadError('unexpected Content-Range from {}: {}'.format(url, response.headers.get('Content-Range')))
+            total = int(match.group(3)) if match.group(3) != '*' else None
+            mode = 'ab'
+            logger.info('resuming {} at byte {}'.format(url, offset))
+        else:
+            # the server sent the whole file
+            offset = 0
+            length = response.headers.get('Content-Length')
+            total = int(length) if length and 'Content-Encoding' not in response.headers else None
+            mode = 'wb'
+        written = offset
+        next_report = written + PROGRESS_INTERVAL
+        with open(part_path, mode) as outf:
+            for chunk in response.iter_content(chunk_size=session.buffer_size):
+                outf.write(chunk)
+                written += len(chunk)
+                if written >= next_report:
+                    logger.info('{}: {} of {} bytes'.format(part_path, written, total or 'unknown'))
+                    next_report += PROGRESS_INTERVAL
+    finally:
+        response.close()
+    if total is not None and written < total:
+        raise IOError('connection closed after {} of {} bytes'.format(written, total))
+    return total, validator
+
+
+def verify_file(path, total=None, size_mb=None, checksum=None):
+    '''checks a downloaded file against the server length, the CMR granule_size (MB) and a checksum. raises IntegrityError'''
+    actual = os.path.getsize(path)
+    if total is not None and actual != total:
+        raise IntegrityError('{} is {} bytes, expected {}'.format(path, actual, total))
+    if size_mb:
+        expected = float(size_mb)
+        # granule_size is rounded and may be in MiB or MB
+        if not any(abs(actual - expected * unit) <= SIZE_TOLERANCE * expected * unit for unit in (1024 * 1024, 1000 * 1000)):
+            raise IntegrityError('{} is {} bytes, expected about {} MB'.format(path, actual, expected))
+    if checksum and checksum.get('value'):
+        algorithm = checksum.get('algorithm', 'md5').lower().replace('-', '')
+        digest = hashlib.new(algorithm)
+        with open(path, 'rb') as fin:
+            for block in iter(lambda: fin.read(BUFFER_SIZE), b''):
+                digest.update(block)
+        if digest.hexdigest().lower() != checksum['value'].lower():
+            raise IntegrityError('{} {} checksum mismatch'.format(path, algorithm))
+
+
+def integrity_from_metadata(metadata, verify_size=True):
+    '''
+    returns the download() size_mb and checksum keyword arguments from CMR granule metadata, where present.
+    the granule_size is left out unless verify_size
+    '''
+    integrity = {}
+    if not metadata:
+        return integrity
+    if verify_size and metadata.get('granule_size'):
+        integrity['size_mb'] = metadata['granule_size']
+    checksum = metadata.get('checksum') or metadata.get('Checksum')
+    if isinstance(checksum, dict):
+        value = checksum.get('value') or checksum.get('Value')
+        algorithm = checksum.get('algorithm') or checksum.get('Algorithm') or 'md5'
+        if value:
+            integrity['checksum'] = {"algorithm": algorithm, "value": value}
+    return integrity
+
+
+def retryable(error):
+    '''returns whether a failed request is worth retrying: connection errors, timeouts, 408, 429 and 5xx responses'''
+    response = getattr(error, 'response', None)
+    if isinstance(error, requests.exceptions.HTTPError) and response is not None:
+        return response.status_code >= 500 or response.status_code in RETRY_CLIENT_STATUS
+    return True
+
+
+def backoff(attempt):
+    '''returns the delay before retry attempt: exponential, capped, with full jitter'''
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+
+
+def record(path, written, elapsed):
+    '''adds a completed download to the metrics'''
+    with _stats_lock:
+        _stats["files"] += 1
+        _stats["bytes"] += written
+        _stats["seconds"] += elapsed
+    logger.info('downloaded {} ({} bytes) in {:.1f}s ({:.2f} MB/s)'.format(path, written, elapsed, rate(written, elapsed)))
+
+
+def rate(written, elapsed):
+    '''returns the throughput in MB/s'''
+    return written / 1e6 / elapsed if elapsed > 0 else 0.0
+
+
+def download_stats():
+    '''returns the totals of all downloads made by this process'''
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["mb_per_second"] = rate(stats["bytes"], stats["seconds"])
+    return stats
+
+
+def log_download_stats():
+    '''logs and prints the totals of all downloads made by this process'''
+    stats = download_stats()
+    message = 'downloaded {files} files, {bytes} bytes in {seconds:.1f}s of transfer time ({mb_per_second:.2f} MB/s)'.format(**stats)
+    logger.info(message)
+    print(message)
+
+
+def parse_size(value):
+    '''parses a size such as "10GB" into bytes. plain numbers are bytes'''
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = SIZE.match(str(value))
+    if match is None:
+        raise ValueError('invalid size: {}'.format(value))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def dir_size(path):
+    '''returns the bytes used by the files under path'''
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                # removed while walking
+                pass
+    return total
+
+
+class DiskGuard(object):
+    '''
+    Throttles downloads into a directory to keep its usage under limit bytes. reserve(size) blocks
+    until the current usage plus the sizes reserved by downloads in flight leave room for size. A
+    reservation is always granted when no other is outstanding, so one oversized product still runs.
+    '''
+    def __init__(self, path, limit, poll_interval=GUARD_POLL_INTERVAL):
+        self.path = path
+        self.limit = limit
+        self.poll_interval = poll_interval
+        self._reserved = 0
+        self._outstanding = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def reserve(self, size=None):
+        '''context manager holding a reservation of size bytes (0 if unknown) for the duration of a download'''
+        size = int(size or 0)
+        with self._cond:
+            waited = False
+            while self._outstanding and dir_size(self.path) + self._reserved + size > self.limit:
+                if not waited:
+                    logger.info('disk usage of {} near {} bytes, waiting to download {} bytes'.format(self.path, self.limit, size))
+                    waited = True
+                self._cond.wait(self.poll_interval)
+            self._reserved += size
+            self._outstanding += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._reserved -= size
+                self._outstanding -= 1
+                self._cond.notify_all()
+
+    def freed(self):
+        '''wakes throttled downloads after files were removed from the directory'''
+        with self._cond:
+            self._cond.notify_all()
+
+
+class _LinkParser(HTMLParser):
+    '''collects the href of every anchor in an html page'''
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            for name, value in attrs:
+                if name == 'href' and value:
+                    self.links.append(value)
+
+
+def list_directory(url, session=None, suffix=None, verify=False, timeout=TIMEOUT):
+    '''lists the files linked from a directory index page at url, without following links to parent directories'''
+    if session is None:
+        session = get_session(pool_size=1)
+    if not url.endswith('/'):
+        url = url + '/'
+    response = session.get(url, verify=verify, timeout=timeout)
+    response.raise_for_status()
+    parser = _LinkParser()
+    parser.feed(response.text)
+    files = []
+    for link in parser.links:
+        file_url = urljoin(url, link).split('?')[0].split('#')[0]
+        if not file_url.startswith(url) or file_url.endswith('/'):
+            continue
+        if suffix and not file_url.endswith(suffix):
+            continue
+        if file_url not in files:
+            files.append(file_url)
+    return files
+
+
+def filename(url):
+    '''returns the file name of a url'''
+    return os.path.basename(urlparse(url).path)
@@ -0,0 +1,250 @@
+'''
+Shared Elasticsearch client for the GRQ and Mozart queries: pooled keep-alive
+sessions, timeouts, retries with backoff, _msearch batching, and a clear
+split between "not found" (a missing index reads as no hits) and an
+unreachable or failing cluster (ESUnavailable).
+'''
+
+from __future__ import print_function
+import json
+import time
+import random
+import threading
+import logging as logger
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import Future
+from hysds.celery import app
+
+POOL_SIZE = 10
+TIMEOUT = 60
+ATTEMPTS = 4
+BACKOFF_BASE = 1.0 # seconds
+BACKOFF_CAP = 30.0
+RETRY_STATUS = (429, 500, 502, 503, 504)
+MSEARCH_SIZE = 100 # searches per _msearch request
+MSEARCH_WAIT = 0.05 # seconds a search waits for others to batch with
+
+_clients = {}
+_batchers = {}
+_clients_lock = threading.Lock()
+
+class ESUnavailable(Exception):
+    '''raised when elasticsearch cannot be reached or keeps failing, as opposed to finding nothing'''
+
+class ESClient(object):
+    '''client for one elasticsearch url. safe to share between threads'''
+    def __init__(self, url, pool_size=POOL_SIZE, timeout=TIMEOUT, attempts=ATTEMPTS):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.attempts = attempts
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, path, body=None, params=None, content_type='application/json'):
+        '''
+        sends a request, retrying connection errors, timeouts and 5xx responses with backoff. returns the
+        parsed response, or None for a 404. raises ESUnavailable once the attempts are used up
+        '''
+        url = '{}/{}'.format(self.url, path.lstrip('/'))
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+        for attempt in range(self.attempts):
+            if attempt:
+                time.sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt))))
+            try:
+                response = self.session.request(method, url, data=body, params=params, verify=False,
+                                                timeout=self.timeout, headers={'Content-Type': content_type})
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+                logger.warning('elasticsearch request to {} failed (attempt {}): {}'.format(url, attempt + 1, e))
+                continue
+            if response.status_code == 404:
+                return None
+            if response.status_code in RETRY_STATUS:
+                error = 'status {}: {}'.format(response.status_code, response.text[:200])
+                logger.warning('elasticsearch request to {} failed (attempt {}): {}'.format(url, attempt + 1, error))
+                continue
+            response.raise_for_status()
+            return json.loads(response.text)
+        raise ESUnavailable('elasticsearch request to {} failed after {} attempts: {}'.format(url, self.attempts, error))
+
+    def search(self, idx, es_query, params=None):
+        '''runs a search on idx. returns the response, with no hits if idx does not exist'''
+        logger.info('querying: {}/{} with {}'.format(self.url, idx, es_query))
+        results = self.request('POST', '{}/_search'.format(idx), es_query, params)
+        return results if results is not None else empty_results()
+
+    def hits(self, idx, es_query):
+        '''returns the hits of a search on idx'''
+        return self.search(idx, es_query).get('hits', {}).get('hits', [])
+
+    def count(self, idx, es_query):
+        '''returns the total hit count of a search on idx'''
+        return total(self.search(idx, es_query))
+
+    def msearch(self, searches):
+        '''
+        runs many (idx, es_query) searches in one _msearch request. returns their responses in order; a search on
+        a missing index has no hits. raises ESUnavailable if a search failed
+        '''
+        if not searches:
+            return []
+        body = ''.join('{}\n{}\n'.format(json.dumps({"index": idx}), json.dumps(es_query)) for idx, es_query in searches)
+        logger.info('multi searching: {} with {} searches'.format(self.url, len(searches)))
+        results = self.request('POST', '_msearch', body, content_type='application/x-ndjson')
+        responses = (results or {}).get('responses', [])
+        if len(responses) != len(searches):
+            raise ESUnavailable('_msearch returned {} responses for {} searches'.format(len(responses), len(searches)))
+        for i, response in enumerate(responses):
+            if 'error' not in response:
+                continue
+            if response.get('status') == 404:
+                responses[i] = empty_results()
+            else:
+                raise ESUnavailable('search on {} failed: {}'.format(searches[i][0], response['error']))
+        return responses
+
+    def scroll(self, idx, es_query, keep_alive='2m'):
+        '''scrolls through every hit of a search on idx. yields lists of hits per page'''
+        logger.info('scrolling: {}/{} with {}'.format(self.url, idx, es_query))
+        results = self.request('POST', '{}/_search'.format(idx), es_query, {'scroll': keep_alive})
+        while results is not None:
+            hits = results.get('hits', {}).get('hits', [])
+            if not hits:
+                return
+            yield hits
+            results = self.request('POST', '_search/scroll', {"scroll": keep_alive, "scroll_id": results['_scroll_id']})
+            if results is None:
+                raise ESUnavailable('scroll on {} expired'.format(idx))
+
+    def bulk(self, lines):
+        '''sends the action and document dicts as one _bulk request. returns the response'''
+        body = ''.join('{}\n'.format(json.dumps(line)) for line in lines)
+        return self.request('POST', '_bulk', body, content_type='application/x-ndjson')
+
+class MultiSearchBatcher(object):
+    '''
+    Collects searches from any number of threads and sends them as one _msearch request once max_size are
+    pending, or max_wait seconds after the first of them, whichever comes first. search() returns a
+    future of the response, which raises ESUnavailable if the batch failed.
+    '''
+    def __init__(self, client, max_size=MSEARCH_SIZE, max_wait=MSEARCH_WAIT):
+        self.client = client
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._pending = []
+        self._first = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='msearch-batcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def search(self, idx, es_query):
+        '''queues a search on idx. returns a future of its response'''
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('multi search batcher is closed')
+            self._pending.append((idx, es_query, future))
+            if len(self._pending) == 1:
+                self._first = time.time()
+            batch = self._take() if len(self._pending) >= self.max_size else None
+            self._cond.notify()
+        if batch:
+            self._send(batch)
+        return future
+
+    def flush(self):
+        '''sends the pending searches now, eg once a caller has queued everything it is about to wait on'''
+        with self._cond:
+            batch = self._take()
+        if batch:
+            self._send(batch)
+
+    def close(self):
+        '''sends the pending searches and stops the batcher'''
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _take(self):
+        '''removes and returns the pending searches. called with the lock held'''
+        batch = self._pending
+        self._pending = []
+        return batch
+
+    def _send(self, batch):
+        '''runs a batch of searches and resolves their futures'''
+        try:
+            responses = self.client.msearch([(idx, es_query) for idx, es_query, _ in batch])
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, _, future), response in zip(batch, responses):
+            future.set_result(response)
+
+    def _run(self):
+        '''sends batches that have waited max_wait'''
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                wait = self._first + self.max_wait - time.time()
+                if wait > 0 and not self._closed:
+                    self._cond.wait(wait)
+                    continue
+                batch = self._take()
+            self._send(batch)
+
+def empty_results():
+    '''returns a search response without hits'''
+    return {"hits": {"total": 0, "hits": []}}
+
+def total(results):
+    '''returns the total hit count of a search response'''
+    count = results.get('hits', {}).get('total', 0)
+    if isinstance(count, dict):
+        # elasticsearch 7 and later
+        count = count.get('value', 0)
+    return int(count)
+
+def get_client(url):
+    '''returns the shared client for an elasticsearch url'''
+    with _clients_lock:
+        if url not in _clients:
+            _clients[url] = ESClient(url)
+        return _clients[url]
+
+def get_batcher(url):
+    '''returns the shared multi search batcher for an elasticsearch url'''
+    client = get_client(url)
+    with _clients_lock:
+        if url not in _batchers:
+            _batchers[url] = MultiSearchBatcher(client)
+        return _batchers[url]
+
+def grq():
+    '''returns the shared GRQ client'''
+    return get_client(app.conf['GRQ_ES_URL'])
+
+def grq_batcher():
+    '''returns the shared GRQ multi search batcher'''
+    return get_batcher(app.conf['GRQ_ES_URL'])
+
+def mozart():
+    '''returns the shared Mozart (jobs) client'''
+    return get_client(app.conf['JOBS_ES_URL'])
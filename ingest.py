@@ -10,12 +10,19 @@ import json
 import urllib3
 import dateutil.parser
 import requests
-from hysds.celery import app
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from browse import generate_browse
+from es_client import grq
+from downloader import get_session, download, integrity_from_metadata, parse_segments, log_download_stats
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 VERSION = "v1.0"
 ALLOWED_EXTENSIONS = ['tif', 'jpg', 'jpeg', 'png']
+BROWSE_EXTENSIONS = ['jpg', 'jpeg', 'png']
+LOCALIZE_WORKERS = 4 # files of a product downloaded at once
+# parallel byte range connections per file, by host. gentle with the AVA
+DOWNLOAD_SEGMENTS = {"default": 1, "ava.jpl.nasa.gov": 1, "e4ftl01.cr.usgs.gov": 4}
 # determined globals
 PROD = "{}-{}-{}" # eg: AST_L1T-20190514T341405_20190514T341435-v1.0
 INDEX = 'grq_{}_{}'
@@ -32,11 +39,13 @@ def main():
     starttime = ctx.get("starttime", False)
     endtime = ctx.get("endtime", False)
     location = ctx.get("location", False)
+    DOWNLOAD_SEGMENTS.update(parse_segments(ctx.get("download_segments")))
+    verify_size = get_flag(ctx, "verify_granule_size", True)
     shortname = metadata.get('short_name')
     #ingest the product
-    ingest_product(shortname, starttime, endtime, location, metadata)
+    ingest_product(shortname, starttime, endtime, location, metadata, verify_size)
 
-def ingest_product(shortname, starttime, endtime, location, metadata):
+def ingest_product(shortname, starttime, endtime, location, metadata, verify_size=True):
     '''determines if the product is localized. if not localizes and ingests the product'''
     # generate product id
     prod_id = gen_prod_id(shortname, starttime, endtime)
@@ -46,7 +55,7 @@ def ingest_product(shortname, starttime, endtime, location, metadata):
         return
     #attempt to localize product
     print('attempting to localize product: {}'.format(prod_id))
-    localize_product(prod_id, metadata)
+    localize_product(prod_id, metadata, verify_size)
     # generate product
     dst, met = gen_jsons(prod_id, starttime, endtime, location, metadata)
     # save the metadata fo;es
@@ -62,66 +71,65 @@ def gen_prod_id(shortname, starttime, endtime):
 def exists(uid, shortname):
     '''queries grq to see if the input id exists. Returns True if it does, False if not'''
     idx = INDEX.format(VERSION, shortname)
-    grq_ip = app.conf['GRQ_ES_URL']#.replace(':9200', '').replace('http://', 'https://')
-    grq_url = '{0}/{1}/_search'.format(grq_ip, idx)
     es_query = {"query": {"bool": {"must": [{"term": {"id.raw": uid}}]}}, "from": 0, "size": 1}
-    return query_es(grq_url, es_query)
+    return grq().count(idx, es_query)
 
-def query_es(grq_url, es_query):
-    '''simple single elasticsearch query, used for existence. returns count of result.'''
-    print('querying: {} with {}'.format(grq_url, es_query))
-    response = requests.post(grq_url, data=json.dumps(es_query), verify=False)
-    try:
-        response.raise_for_status()
-    except:
-        # if there is an error (or 404,just publish
-        return 0
-    results = json.loads(response.text, encoding='ascii')
-    #results_list = results.get('hits', {}).get('hits', [])
-    total_count = results.get('hits', {}).get('total', 0)
-    return int(total_count)
-
-def localize_product(prod_id, metadata):
-    '''attempts to localize the product'''
+def localize_product(prod_id, metadata, verify_size=True):
+    '''
+    attempts to localize the product. the hdf and the browse/tif files are downloaded concurrently. the hdf
+    is checked against the CMR granule_size if verify_size
+    '''
     if not os.path.exists(prod_id):
         os.mkdir(prod_id)
     ava_url = metadata.get('ava_url', False)
     if ava_url is False:
         raise Exception('cannot localize product. metadata.ava_url parameter is empty')
     prod_path = os.path.join(prod_id, '{}.{}'.format(prod_id, 'hdf'))
-    localize(ava_url, prod_path)
+    # path -> (url, required, integrity checks)
+    downloads = {prod_path: (ava_url, True, integrity_from_metadata(metadata, verify_size))}
     for obj in metadata.get('links', []):
         url = obj.get('href', False)
+        if not url:
+            continue
         extension = os.path.splitext(url)[1].strip('.')
         if extension in ALLOWED_EXTENSIONS:
             product_path = os.path.join(prod_id, '{}.{}'.format(prod_id, extension))
-            if not os.path.exists(product_path):
-                localize(url, product_path)
-        if extension in ['jpg', 'jpeg', 'png']:
+            if not os.path.exists(product_path) and product_path not in downloads:
+                downloads[product_path] = (url, False, {})
+    session = get_session(pool_size=LOCALIZE_WORKERS, segments=DOWNLOAD_SEGMENTS)
+    with ThreadPoolExecutor(max_workers=LOCALIZE_WORKERS) as executor:
+        futures = dict((executor.submit(localize, url, path, session, **integrity), (url, path, required))
+                       for path, (url, required, integrity) in downloads.items())
+        for future in as_completed(futures):
+            url, path, required = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                # browse and tif files are optional
+                if required:
+                    raise
+                print('unable to localize optional file from url: {} ({})'.format(url, e))
+    log_download_stats()
+    for extension in BROWSE_EXTENSIONS:
+        product_path = os.path.join(prod_id, '{}.{}'.format(prod_id, extension))
+        if os.path.exists(product_path):
             #attempt to generate browse
-            generate_browse(product_path, prod_id)
+            try:
+                generate_browse(product_path, prod_id)
+            except Exception as e:
+                print('unable to generate browse for {}: {}'.format(prod_id, e))
 
-def localize(url, prod_path):
-    '''attempts to localize the product'''
-    status = os.system('wget --no-check-certificate -O {} {}'.format(prod_path, url))
-    if status == 0:
+def localize(url, prod_path, session=None, size_mb=None, checksum=None):
+    '''attempts to localize the product, verifying it against the CMR size and checksum when given'''
+    try:
+        download(url, prod_path, session, size_mb=size_mb, checksum=checksum)
         #succeeds
         if os.path.exists(prod_path):
             return
+    except (requests.exceptions.RequestException, IOError) as e:
+        print('localization from url: {} failed: {}'.format(url, e))
     raise Exception("unable to localize product from url: {}".format(url))
 
-def generate_browse(product_path, prod_id):
-    '''attempts to generate browse if it doesn't already exist'''
-    browse_path = os.path.join(prod_id, '{}.browse.png'.format(prod_id))
-    browse_small_path = os.path.join(prod_id, '{}.browse_small.png'.format(prod_id))
-    if os.path.exists(browse_path):
-        return
-    #conver to png
-    os.system("convert {} {}".format(product_path, browse_path))
-    #convert to small png
-    os.system("convert {} -resize 300x300 {}".format(product_path, browse_small_path))
-    os.remove(product_path)
-
 def gen_jsons(prod_id, starttime, endtime, location, metadata):
     '''generates ds and met json blobs'''
     ds = {"label": prod_id, "starttime": starttime, "endtime": endtime, "location": location, "version": VERSION}
@@ -139,6 +147,13 @@ def save_product_met(prod_id, ds_obj, met_obj):
     with open(outpath, 'w') as outf:
         json.dump(met_obj, outf)
 
+def get_flag(ctx, name, default=False):
+    '''returns a boolean context param, which may arrive as a bool or a string'''
+    value = ctx.get(name)
+    if value in (None, ''):
+        return default
+    return str(value).lower() == 'true'
+
 def load_context():
     '''loads the context file into a dict'''
     try:
@@ -8,20 +8,42 @@ from __future__ import print_function
 import os
 import glob
 import json
-import subprocess
+import time
+import shutil
 import urllib3
 import dateutil.parser
 import requests
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from hysds.celery import app
+from hysds.dataset_ingest import ingest
+from browse import generate_browse, generate_browses
+from acquisition_key import acquisition_key
+from es_client import grq_batcher
+from downloader import get_session, download, list_directory, filename, integrity_from_metadata, parse_segments, backoff, log_download_stats, DiskGuard, parse_size
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 VERSION = "v1.0"
 ALLOWED_EXTENSIONS = ['tif', 'jpg', 'jpeg', 'png']
+BROWSE_EXTENSIONS = ['jpg', 'jpeg', 'png']
 # determined globals
 PROD = "{}-{}-{}"  # eg: AST_L1T-20190514T341405_20190514T341435-v1.0
 INDEX = 'grq_{}_{}'  # e.g. grq_v1.0_ast_09t
 INDEX_METADATA = 'grq_{}_metadata-{}'  # e.g. grq_v1.0_metadata-ast_09t
+MAX_TURNS = 10
+MET_WORKERS = 8 # met files downloaded at once
+GRANULE_WORKERS = 1 # granules localized at once
+MAX_DISK_USAGE = "5GB" # the job spec disk_usage
+RESOLVE_BATCH = 100 # granules resolved against GRQ at a time
+RESOLVE_CHUNK = 100 # granules per query, two wildcard clauses each
+ES_TERMS_CHUNK = 500
+ES_MAX_SIZE = 10000
+# parallel byte range connections per file, by host. gentle with the AVA
+DOWNLOAD_SEGMENTS = {"default": 1, "ava.jpl.nasa.gov": 1, "e4ftl01.cr.usgs.gov": 4}
+SESSION = get_session(segments=DOWNLOAD_SEGMENTS)
+# met files are a few KB, so they are never split into segments
+MET_SESSION = get_session(pool_size=MET_WORKERS)
 
 
 def main():
@@ -29,78 +51,44 @@ def main():
     # load parameters
     ctx = load_context()
     lpdaac_download_url = ctx.get("lpdaac_download_url", False)
+    SESSION.segments.update(parse_segments(ctx.get("download_segments")))
     # check if lpdaac_download_url has a trailing "/" character
     if lpdaac_download_url[:-1] != "/":
         lpdaac_download_url = "{}{}".format(lpdaac_download_url,"/")
     print("lpdaac_download_url: {}".format(lpdaac_download_url))
 
-    # download granules from lpdaac_download_url
-    granule_download_dir = localize_granules(lpdaac_download_url)
-    print("granule_download_dir: {}".format(granule_download_dir))
-
-    # get list of granules from lpdaac_download_url
-    granule_ids = list_granules(granule_download_dir)
-    print("granule_ids: {}".format(granule_ids))
-
-    # query metadata in AVA based on version, acquisition_date, and short_name
-    for id in granule_ids:
-        id_items = id.split('_')
-        short_name = "{}_{}".format(id_items[0], id_items[1])
-        version_acquisition_date = id_items[2]
-
-        # check AST_L1B or AST_09T index
-        idx = INDEX.format(VERSION, short_name.lower())
-        if exists(idx, version_acquisition_date, short_name):
-            print("granule ID {} already exists in AVA for version_acquisition_date {}".format(id, version_acquisition_date))
-            continue
-        else:
-            version_acquisition_date_underscore = version_acquisition_date[0:3] + "_" + version_acquisition_date[3:]
-            if exists(idx, version_acquisition_date_underscore, short_name):
-                print("granule ID {} already exists in AVA for version_acquisition_date {}".format(id, version_acquisition_date_underscore))
-                continue
-            else:
-
-                # check metadata index 
-                idx = INDEX_METADATA.format(VERSION, short_name.lower()) 
-                metadata_found = exists(idx, version_acquisition_date, short_name)
-                if metadata_found:
-                    granule_results = query_es_metdata(idx, version_acquisition_date, short_name)
-                    # generate product id
-                    granule_metadata_id = granule_results['_id']
-                    prod_id = gen_prod_id(granule_metadata_id)
-                    # attempt to localize product
-                    hdf_items = id.split('.')
-                    granule_hdf = "{}.{}".format(hdf_items[0], hdf_items[1])
-                    metadata = granule_results.get("_source",False).get("metadata", False)
-                    localize_product(lpdaac_download_url, granule_hdf, prod_id, metadata)
-                    # generate product
-                    granule_metadata_source = granule_results.get("_source",False)
-                    dst, met = gen_jsons(prod_id, granule_metadata_source)
-                    # save the metadata files
-                    save_product_met(prod_id, dst, met)
-                elif not metadata_found:
-                    metadata_found = exists(idx, version_acquisition_date_underscore, short_name)
-                    if metadata_found:
-                        granule_results = query_es_metdata(idx, version_acquisition_date_underscore, short_name)
-                        # generate product id
-                        granule_metadata_id = granule_results['_id']
-                        prod_id = gen_prod_id(granule_metadata_id)
-                        # attempt to localize product
-                        hdf_items = id.split('.')
-                        granule_hdf = "{}.{}".format(hdf_items[0], hdf_items[1])
-                        metadata = granule_results.get("_source",False).get("metadata", False)
-                        localize_product(lpdaac_download_url, granule_hdf, prod_id, metadata)
-                        # generate product
-                        granule_metadata_source = granule_results.get("_source",False)
-                        dst, met = gen_jsons(prod_id, granule_metadata_source)
-                        # save the metadata files
-                        save_product_met(prod_id, dst, met)
-                    else:
-                        print("Could not find metadata for granule ID {} in AVA using version_acquisition_date_underscore {}".format(id, version_acquisition_date_underscore))
-                        continue
-                else:
-                    print("Could not find metadata for granule ID {} in AVA using version_acquisition_date {}".format(id, version_acquisition_date))
+    # download granule met files from lpdaac_download_url, processing each granule as its met file lands
+    granule_ids = crawl_granules(lpdaac_download_url)
+
+    # query metadata in AVA based on version, acquisition_date, and short_name, a batch of granules at a time,
+    # and localize the products of up to granule_workers granules at once
+    granule_workers = int(ctx.get("granule_workers") or GRANULE_WORKERS)
+    publish = get_flag(ctx, "publish_products")
+    wildcard_fallback = get_flag(ctx, "wildcard_fallback", True)
+    # the ordered file can be a different production than the granule_size of its MET product
+    verify_size = get_flag(ctx, "verify_granule_size")
+    guard = DiskGuard(os.getcwd(), parse_size(ctx.get("max_disk_usage") or MAX_DISK_USAGE))
+    browses = []
+    with ThreadPoolExecutor(max_workers=granule_workers) as executor:
+        futures = []
+        for batch in iter_batches(granule_ids, RESOLVE_BATCH):
+            resolved = resolve_granules(batch, wildcard_fallback)
+            for id in batch:
+                ingested, granule_results = resolved[id]
+                if ingested:
+                    print("granule ID {} already exists in AVA".format(id))
                     continue
+                if granule_results is None:
+                    print("Could not find metadata for granule ID {} in AVA".format(id))
+                    continue
+                futures.append(executor.submit(process_granule, lpdaac_download_url, id, granule_results, guard, publish, verify_size))
+        for future in as_completed(futures):
+            browse = future.result()
+            if browse:
+                browses.append(browse)
+    # generate browse for all localized products at once
+    generate_browses(browses)
+    log_download_stats()
 
 
 
@@ -143,6 +131,53 @@ def main():
 #     save_product_met(prod_id, dst, met)
 
 
+def process_granule(lpdaac_download_url, id, granule_results, guard, publish=False, verify_size=False):
+    '''
+    localizes the product of a granule and saves its metadata, checking the hdf against the CMR granule_size if
+    verify_size. if publish, generates its browse, publishes it and removes the product directory. otherwise
+    returns the (image, prod_id) to generate browse from, if any
+    '''
+    # generate product id
+    prod_id = gen_prod_id(granule_results['_id'])
+    # attempt to localize product, once there is room for it
+    hdf_items = id.split('.')
+    granule_hdf = "{}.{}".format(hdf_items[0], hdf_items[1])
+    metadata = granule_results.get("_source",False).get("metadata", False)
+    size_mb = integrity_from_metadata(metadata).get('size_mb')
+    with guard.reserve(float(size_mb) * 1024 * 1024 if size_mb else None):
+        browse_source = localize_product(lpdaac_download_url, granule_hdf, prod_id, metadata, verify_size)
+    # generate product
+    granule_metadata_source = granule_results.get("_source",False)
+    dst, met = gen_jsons(prod_id, granule_metadata_source)
+    # save the metadata files
+    save_product_met(prod_id, dst, met)
+    if not publish:
+        if browse_source:
+            return browse_source, prod_id
+        return None
+    # the directory is removed once published, so browse has to be generated first
+    if browse_source:
+        try:
+            generate_browse(browse_source, prod_id)
+        except Exception as e:
+            print('unable to generate browse for {}: {}'.format(prod_id, e))
+    publish_product(prod_id)
+    guard.freed()
+    return None
+
+
+def publish_product(prod_id):
+    '''publishes a complete product directory, then removes it to free the disk'''
+    ds_dir = os.path.join(os.getcwd(), prod_id)
+    print('publishing product: {}'.format(prod_id))
+    try:
+        ingest(prod_id, './datasets.json', app.conf.GRQ_UPDATE_URL, app.conf.DATASET_PROCESSED_QUEUE, ds_dir, None)
+    except Exception as e:
+        raise Exception('failed on submission of {0}: {1}'.format(prod_id, e))
+    if os.path.exists(ds_dir):
+        shutil.rmtree(ds_dir)
+
+
 def gen_prod_id(id):
     '''generates the product id from the input metadata & params'''
     id_items = id.split('-')
@@ -153,55 +188,121 @@ def gen_prod_id(id):
     return PROD_ID
 
 
-def exists(idx, uid, short_name):
-    '''queries grq to see if the input id exists. Returns True if it does, False if not'''
-    # idx = INDEX.format(VERSION, short_name.lower())
-    # .replace(':9200', '').replace('http://', 'https://')
-    uid = "*"+uid+"*"
-    grq_ip = app.conf['GRQ_ES_URL']
-    grq_url = '{0}/{1}/_search'.format(grq_ip, idx)
-    # es_query = {"query":{"bool":{"must":[{"query_string":{"default_field":"_all","query":uid}},{"query_string":{"default_field":"metadata.short_name.raw","query":short_name}}],"must_not":[],"should":[]}},"from":0,"size":1,"sort":[],"aggs":{}}
-    es_query = {"query":{"bool":{"must":[{"wildcard":{"metadata.producer_granule_id.raw":uid}},{"query_string":{"default_field":"metadata.short_name.raw","query":short_name}}],"must_not":[],"should":[]}},"from":0,"size":1,"sort":[],"aggs":{}}
-    return query_es(grq_url, es_query)
-
-
-def query_es(grq_url, es_query):
-    '''simple single elasticsearch query, used for existence. returns count of result.'''
-    print('querying: {} with {}'.format(grq_url, es_query))
-    response = requests.post(grq_url, data=json.dumps(es_query), verify=False)
-    try:
-        response.raise_for_status()
-    except:
-        # if there is an error (or 404,just publish
-        return 0
-    text = response.text.encode('ascii')
-    results = json.loads(text)
-    #results_list = results.get('hits', {}).get('hits', [])
-    total_count = results.get('hits', {}).get('total', 0)
-    return int(total_count)
-
-def query_es_metdata(idx, uid, short_name):
-    '''simple single elasticsearch query, used for existence. returns count of result.'''
-    uid = "*"+uid+"*"
-    grq_ip = app.conf['GRQ_ES_URL']
-    grq_url = '{0}/{1}/_search'.format(grq_ip, idx)
-    # es_query = {"query":{"bool":{"must":[{"query_string":{"default_field":"_all","query":uid}},{"query_string":{"default_field":"metadata.short_name.raw","query":short_name}}],"must_not":[],"should":[]}},"from":0,"size":1,"sort":[],"aggs":{}}
-    es_query = {"query":{"bool":{"must":[{"wildcard":{"metadata.producer_granule_id.raw":uid}},{"query_string":{"default_field":"metadata.short_name.raw","query":short_name}}],"must_not":[],"should":[]}},"from":0,"size":1,"sort":[],"aggs":{}}
-    print('querying: {} with {}'.format(grq_url, es_query))
-    response = requests.post(grq_url, data=json.dumps(es_query), verify=False)
-    try:
-        response.raise_for_status()
-    except:
-        # if there is an error (or 404,just publish
-        return 0
-    text = response.text.encode('ascii')
-    results = json.loads(text)
-    results_list = results.get('hits', {}).get('hits', [])
-    return results_list[0]
-
-
-def localize_product(lpdaac_download_url, granule_hdf, prod_id, metadata):
-    '''attempts to localize the product'''
+def iter_batches(items, size):
+    '''yields lists of up to size items from an iterable'''
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def granule_variants(id):
+    '''returns the short name and the version_acquisition_date variants (without and with the underscore) of a granule id'''
+    id_items = id.split('_')
+    short_name = "{}_{}".format(id_items[0], id_items[1])
+    version_acquisition_date = id_items[2]
+    version_acquisition_date_underscore = version_acquisition_date[0:3] + "_" + version_acquisition_date[3:]
+    return short_name, [version_acquisition_date, version_acquisition_date_underscore]
+
+
+def resolve_granules(granule_ids, wildcard_fallback=True):
+    '''
+    resolves a batch of granule ids against the product and metadata indices. every index is searched by exact
+    acquisition_key first, then, if wildcard_fallback, by producer_granule_id wildcards for the granules without a
+    keyed match (products not yet backfilled), each round sent as one _msearch. returns a dict of
+    granule id: (exists in the product index, metadata index hit or None)
+    '''
+    by_short_name = {}
+    for id in granule_ids:
+        short_name, uids = granule_variants(id)
+        by_short_name.setdefault(short_name, []).append((id, uids))
+    # check AST_L1B or AST_09T index and the metadata index
+    lookups = {}
+    for short_name, granules in by_short_name.items():
+        lookups[INDEX.format(VERSION, short_name.lower())] = (short_name, granules, ["metadata.producer_granule_id", "metadata.acquisition_key"])
+        lookups[INDEX_METADATA.format(VERSION, short_name.lower())] = (short_name, granules, None)
+    batcher = grq_batcher()
+    pending = {}
+    for idx, (short_name, granules, source) in lookups.items():
+        keys = {}
+        for id, _ in granules:
+            key = acquisition_key(short_name, id)
+            if key:
+                keys[key] = id
+        pending[idx] = (keys, query_es_keys(batcher, idx, list(keys), source))
+    batcher.flush()
+    matched = {}
+    for idx, (keys, futures) in pending.items():
+        matched[idx] = {}
+        for hit in future_hits(futures):
+            id = keys.get(hit.get('_source', {}).get('metadata', {}).get('acquisition_key'))
+            if id is not None and id not in matched[idx]:
+                matched[idx][id] = hit
+    if wildcard_fallback:
+        pending = {}
+        for idx, (short_name, granules, source) in lookups.items():
+            remaining = [granule for granule in granules if granule[0] not in matched[idx]]
+            pending[idx] = (remaining, query_es_granules(batcher, idx, short_name, remaining, source))
+        batcher.flush()
+        for idx, (remaining, futures) in pending.items():
+            if remaining:
+                matched[idx].update(match_hits(remaining, future_hits(futures)))
+    resolved = {}
+    for short_name, granules in by_short_name.items():
+        ingested = matched[INDEX.format(VERSION, short_name.lower())]
+        metadata = matched[INDEX_METADATA.format(VERSION, short_name.lower())]
+        for id, _ in granules:
+            resolved[id] = (id in ingested, None if id in ingested else metadata.get(id))
+    return resolved
+
+
+def query_es_keys(batcher, idx, keys, source=None):
+    '''queues the searches of idx for the documents with the given acquisition keys. returns their futures'''
+    futures = []
+    for i in range(0, len(keys), ES_TERMS_CHUNK):
+        chunk = keys[i:i + ES_TERMS_CHUNK]
+        es_query = {"query":{"terms":{"metadata.acquisition_key.raw":chunk}},"from":0,"size":ES_MAX_SIZE}
+        if source is not None:
+            es_query["_source"] = source
+        print('querying: {} for {} acquisition keys'.format(idx, len(chunk)))
+        futures.append(batcher.search(idx, es_query))
+    return futures
+
+
+def query_es_granules(batcher, idx, short_name, granules, source=None):
+    '''queues the searches of idx for every producer_granule_id matching any of the granules' uid variants. returns their futures'''
+    futures = []
+    for i in range(0, len(granules), RESOLVE_CHUNK):
+        should = [{"wildcard":{"metadata.producer_granule_id.raw":"*"+uid+"*"}} for _, uids in granules[i:i + RESOLVE_CHUNK] for uid in uids]
+        es_query = {"query":{"bool":{"must":[{"query_string":{"default_field":"metadata.short_name.raw","query":short_name}}],"should":should,"minimum_should_match":1}},"from":0,"size":ES_MAX_SIZE}
+        if source is not None:
+            es_query["_source"] = source
+        print('querying: {} for {} granules by producer_granule_id'.format(idx, len(should) // 2))
+        futures.append(batcher.search(idx, es_query))
+    return futures
+
+
+def future_hits(futures):
+    '''waits for search futures. returns all their hits'''
+    return [hit for future in futures for hit in future.result().get('hits', {}).get('hits', [])]
+
+
+def match_hits(granules, hits):
+    '''matches hits back to granules by producer_granule_id, preferring the first uid variant. returns a dict of granule id: hit'''
+    matched = {}
+    for id, uids in granules:
+        for uid in uids:
+            hit = next((hit for hit in hits if uid in hit.get('_source', {}).get('metadata', {}).get('producer_granule_id', '')), None)
+            if hit is not None:
+                matched[id] = hit
+                break
+    return matched
+
+
+def localize_product(lpdaac_download_url, granule_hdf, prod_id, metadata, verify_size=False):
+    '''attempts to localize the product. returns the image to generate browse from, if any'''
     if not os.path.exists(prod_id):
         os.mkdir(prod_id)
         print("Created directory: {}".format(prod_id))
@@ -210,88 +311,84 @@ def localize_product(lpdaac_download_url, granule_hdf, prod_id, metadata):
         # get granule hdf from lpdaac url
         ava_url = "{}{}".format(lpdaac_download_url, granule_hdf)
         prod_path = os.path.join(prod_id, granule_hdf)
-        localize_file(ava_url, prod_path)
+        localize_file(ava_url, prod_path, **integrity_from_metadata(metadata, verify_size))
     else:
         # get granule hdf from ava
         prod_path = os.path.join(prod_id, '{}.{}'.format(prod_id, 'hdf'))
-        localize_file(ava_url, prod_path)
+        localize_file(ava_url, prod_path, **integrity_from_metadata(metadata, verify_size))
+    browse_source = None
     for obj in metadata.get('links', []):
         # localize links from extensions
         url = obj.get('href', False)
+        if not url:
+            continue
         extension = os.path.splitext(url)[1].strip('.')
-        if extension in ALLOWED_EXTENSIONS:
-            product_path = os.path.join(prod_id, '{}.{}'.format(prod_id, extension))
-            if not os.path.exists(product_path):
-                localize_file(url, product_path)
-        if extension in ['jpg', 'jpeg', 'png']:
-            # attempt to generate browse
-            generate_browse(product_path, prod_id)
-
-
-def localize_granules(url):
-    '''attempts to localize the product'''
-    max_turns = 10
-    turn = 0
+        if extension not in ALLOWED_EXTENSIONS:
+            continue
+        product_path = os.path.join(prod_id, '{}.{}'.format(prod_id, extension))
+        if not os.path.exists(product_path):
+            localize_file(url, product_path)
+        if extension in BROWSE_EXTENSIONS and browse_source is None:
+            # browse is generated from the first image
+            browse_source = product_path
+    return browse_source
+
+
+def crawl_granules(url, workers=MET_WORKERS):
+    '''
+    lists the lpdaac download directory once and fetches its .hdf.met files concurrently, skipping files
+    already downloaded. yields the granule ids as their met files land
+    '''
     wd = os.getcwd()
     granule_download_dir = os.path.join(wd, "Downloads")
-    cmd = ['wget', '-r', '-np', '-nd', '-A',
-           '.met', url, '-P', granule_download_dir]
-    while turn < max_turns:
-        status = subprocess.call(cmd)
-        # status = os.system(
-        #     'wget -r -np -nd -A .met {} -P {}'.format(url, granule_download_dir))
-        if status == 0:
-            # succeeds
-            if os.path.exists(granule_download_dir):
-                print("localized products from url: {} to {}".format(url, granule_download_dir))
-                return granule_download_dir
-        else:
-            turn = turn + 1
-    raise Exception("unable to localize products from url: {} to {}".format(url, granule_download_dir))
-
-def localize_file(url, prod_path):
-    '''attempts to localize the product'''
-    max_turns = 10
+    if not os.path.exists(granule_download_dir):
+        os.mkdir(granule_download_dir)
     turn = 0
-    cmd  = ['wget', '--no-check-certificate', '-O', prod_path, url]
-    while turn < max_turns:
-        status = subprocess.call(cmd)
-        # status = os.system('wget --no-check-certificate -O {} {}'.format(prod_path, url))
-        if status == 0:
-            #succeeds
-            if os.path.exists(prod_path):
-                print("localized products from url: {} to {}".format(url, prod_path))
-                return
-        else:
+    while True:
+        try:
+            met_urls = list_directory(url, MET_SESSION, suffix='.hdf.met')
+            break
+        except requests.exceptions.RequestException as e:
             turn = turn + 1
-    raise Exception("unable to localize products from url: {} to {}".format(url, prod_path))
-
+            if turn >= MAX_TURNS:
+                raise Exception("unable to list granules from url: {} ({})".format(url, e))
+            print("listing url: {} failed: {}".format(url, e))
+            time.sleep(backoff(turn))
+    print("found {} granules at url: {}".format(len(met_urls), url))
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for met_url in met_urls:
+            granule_id = filename(met_url)
+            met_path = os.path.join(granule_download_dir, granule_id)
+            if os.path.exists(met_path):
+                # downloads only appear once complete
+                yield granule_id
+                continue
+            futures[executor.submit(download, met_url, met_path, MET_SESSION)] = granule_id
+        for future in as_completed(futures):
+            granule_id = futures[future]
+            try:
+                future.result()
+            except (requests.exceptions.RequestException, IOError) as e:
+                print("unable to localize {}: {}".format(granule_id, e))
+                failed.append(granule_id)
+                continue
+            yield granule_id
+    if failed:
+        raise Exception("unable to localize {} granules from url: {} to {}".format(len(failed), url, granule_download_dir))
 
-def list_granules(granule_download_dir):
-    granule_ids = []
+def localize_file(url, prod_path, size_mb=None, checksum=None):
+    '''attempts to localize the product, resuming partial downloads and verifying against the CMR size and checksum when given'''
     try:
-        for file in os.listdir(granule_download_dir):
-            if file.endswith(".hdf.met"):
-                granule_ids.append(file)
-        return granule_ids
-    except:
-        raise Exception(
-            "Could not get list of granule_ids from {}".format(granule_download_dir))
-
-
-def generate_browse(product_path, prod_id):
-    '''attempts to generate browse if it doesn't already exist'''
-    browse_path = os.path.join(prod_id, '{}.browse.png'.format(prod_id))
-    browse_small_path = os.path.join(
-        prod_id, '{}.browse_small.png'.format(prod_id))
-    if os.path.exists(browse_path):
-        return
-    # conver to png
-    os.system("convert {} {}".format(product_path, browse_path))
-    # convert to small png
-    os.system(
-        "convert {} -resize 300x300 {}".format(product_path, browse_small_path))
-    os.remove(product_path)
+        download(url, prod_path, SESSION, attempts=MAX_TURNS, size_mb=size_mb, checksum=checksum)
+        #succeeds
+        if os.path.exists(prod_path):
+            print("localized products from url: {} to {}".format(url, prod_path))
+            return
+    except (requests.exceptions.RequestException, IOError) as e:
+        print("localization from url: {} failed: {}".format(url, e))
+    raise Exception("unable to localize products from url: {} to {}".format(url, prod_path))
 
 
 def gen_jsons(prod_id, metadata):
@@ -319,6 +416,14 @@ def save_product_met(prod_id, ds_obj, met_obj):
         json.dump(met_obj, outf)
 
 
+def get_flag(ctx, name, default=False):
+    '''returns a boolean context param, which may arrive as a bool or a string'''
+    value = ctx.get(name)
+    if value in (None, ''):
+        return default
+    return str(value).lower() == 'true'
+
+
 def load_context():
     '''loads the context file into a dict'''
     try:
@@ -5,12 +5,14 @@ import re
 import time
 import json
 import argparse
-import requests
 import logging
 import boto3
 import zipfile
-from submit_job import main as submit_job
-from hysds.celery import app
+from itertools import islice
+from collections import namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from submit_job import submit_jobs
+from es_client import mozart
 from email import policy
 from email.parser import BytesParser
 
@@ -27,6 +29,18 @@ QUEUE = "factotum-job_worker-small"
 PRIORITY = 5
 TAG = "{}-ingest_from_lpdaac-id-{}"
 PARAMS = {"lpdaac_download_url": ""}
+SUBMIT_RATE = 5.0 # jobs per second
+SUBMIT_BURST = 10
+PARSE_WORKERS = 4
+PARSE_CHUNK = 20 # emails per worker task
+ORDER_CHUNK = 100 # order ids per mozart query
+ES_MAX_SIZE = 10000
+S3_WORKERS = 8 # concurrent email downloads
+MANIFEST_KEY = "ingest_from_lpdaac_emails.manifest.json" # default manifest location, in the email bucket
+
+# order fields of the lpdaac emails, eg "ORDERID: 0600123456" or "HOST: e4ftl01.cr.usgs.gov"
+ORDER_FIELDS = re.compile(r'(ORDERID|(?:MEDIATYPE|HOST|DIR)(?=:)):?[ \t]*([^\r\n]*)')
+Order = namedtuple('Order', ['order_id', 'lpdaac_download_url', 'source'])
 
 # aws profile
 boto3.setup_default_session(profile_name='saml-pub')
@@ -34,31 +48,112 @@ boto3.setup_default_session(profile_name='saml-pub')
 def main(args):
     '''Localizes and ingests product from input metadata blob'''
 
-    # get list of all emails in directory
-    emails = import_lpdaac_emails(args)
-    # loop through the emails
+    # load parameters. the context is optional when reading a local directory of emails
+    ctx = load_context() if not args.dir or os.path.exists('_context.json') else {}
+    # command line settings win over the job context
+    parse_workers = args.parse_workers or int(ctx.get("parse_workers") or PARSE_WORKERS)
+    if args.submit_rate is not None:
+        submit_rate = args.submit_rate
+    elif ctx.get("submit_rate") not in (None, ''):
+        submit_rate = float(ctx["submit_rate"])
+    else:
+        submit_rate = SUBMIT_RATE
+    if parse_workers < 1:
+        raise Exception("parse_workers must be at least 1.")
+    if submit_rate < 0:
+        raise Exception("submit_rate must be 0 (no limit) or more.")
+
+    # get the email directory, and the s3 manifest to record its emails in once processed
+    directory, manifest = import_lpdaac_emails(args, ctx)
+    # get order ids and lpdaac download links from all emails, as they are read
+    orders = parse_emails(iter_emails(directory), parse_workers)
+    # find the orders with a job queued or job completed in one pass
+    existing = query_existing_orders(list(orders))
     logger.info("ORDER_ID, LPDAAC_DOWNLOAD_LINK")
-    for email in emails:
-        # get order id and lpdaac download link
-        order = scrape_emails(email)
-        if order:
-            order_id = order[0]
-            # if there is a job queued or job completed with order id, continue to the next email
-            if query_es(order_id) != 0:
-                continue
-            # else, submit ingest_lpdaac_prod job with order_id and lpdaac download link.
+    jobs = []
+    job_orders = []
+    for order_id, lpdaac_download_link in orders.items():
+        # if there is a job queued or job completed with order id, continue to the next order
+        if order_id in existing:
+            continue
+        # else, submit ingest_lpdaac_prod job with order_id and lpdaac download link.
+        logger.info("{}, {}".format(order_id, lpdaac_download_link))
+        tag = TAG.format(time.strftime('%Y%m%d'), order_id)
+        jobs.append((JOB_NAME, dict(PARAMS, lpdaac_download_url=lpdaac_download_link), tag))
+        job_orders.append(order_id)
+    results = submit_jobs(jobs, JOB_VERSION, QUEUE, PRIORITY, rate=submit_rate, burst=SUBMIT_BURST)
+    failed = [job_orders[index] for index, result in results.items() if "error" in result]
+    for index, result in sorted(results.items()):
+        if "error" in result:
+            logger.error("{}, submission failed: {}".format(job_orders[index], result["error"]))
+    if failed:
+        # the manifest is left as is, so the emails are read again next run
+        raise Exception("unable to submit jobs for {} of {} orders: {}".format(len(failed), len(jobs), ", ".join(failed)))
+    # only now are the downloaded emails done with
+    if manifest is not None:
+        save_manifest(*manifest)
+
+
+def parse_emails(emails, workers=PARSE_WORKERS):
+    '''parses the (bytes, source) emails. returns a dict of order id: lpdaac download link, in email order'''
+    orders = {}
+    for order in iter_orders(emails, workers):
+        # the same order can be in more than one email
+        if order.order_id not in orders:
+            orders[order.order_id] = order.lpdaac_download_url
+    print("found {} orders".format(len(orders)))
+    return orders
+
+
+def iter_orders(emails, workers=PARSE_WORKERS):
+    '''
+    parses the (bytes, source) emails in a process pool, PARSE_CHUNK per task. emails are only read as
+    tasks free up, with at most two tasks per worker in flight. yields the orders in email order
+    '''
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for batch in iter_batches(emails, PARSE_CHUNK):
+            pending.append(executor.submit(scrape_email_batch, batch))
+            if len(pending) >= workers * 2:
+                for order in pending.popleft().result():
+                    yield order
+        while pending:
+            for order in pending.popleft().result():
+                yield order
+
+
+def iter_emails(directory):
+    '''yields the (bytes, source) of every email under directory, reading zip archive members without extracting them'''
+    for root, dirs, files in os.walk(directory, topdown=True):
+        for f in sorted(files):
+            email_file_path = os.path.join(root, f)
+            if f.endswith('.zip'):
+                with zipfile.ZipFile(email_file_path, 'r') as zip_ref:
+                    for member in zip_ref.infolist():
+                        if member.filename.endswith('/'):
+                            continue
+                        yield zip_ref.read(member), "{}:{}".format(email_file_path, member.filename)
             else:
-                lpdaac_download_link = order[1]
-                logger.info("{}, {}".format(order_id, lpdaac_download_link))
-                tag = TAG.format(time.strftime('%Y%m%d'), order_id)
-                PARAMS['lpdaac_download_url'] = lpdaac_download_link
-                submit_job(JOB_NAME, PARAMS, JOB_VERSION, QUEUE, PRIORITY, tag)
-                time.sleep(2)
+                with open(email_file_path, 'rb') as fin:
+                    yield fin.read(), email_file_path
+
+
+def iter_batches(items, size):
+    '''yields lists of up to size items from an iterable'''
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
 
 
-def import_lpdaac_emails(args):
-    '''Import AST HDF met file from LPDAAC as dictionary'''
-    emails = []
+def import_lpdaac_emails(args, ctx):
+    '''
+    Import AST HDF met file from LPDAAC as dictionary. returns the directory of emails, and the (location, objects)
+    manifest to save once they are processed when they come from s3
+    '''
+    manifest = None
 
     # check for a given directory
     if (args.dir):
@@ -68,123 +163,142 @@ def import_lpdaac_emails(args):
             directory = "{}{}".format(directory, "/")
         print("lpdaac_email_directory: {}".format(directory))
     else:
-        # load parameters
-        ctx = load_context()
         s3_bucket = ctx.get("s3_lpdaac_email_bucket", False)
         if s3_bucket:
-            directory = download_files_from_s3(s3_bucket)
-
-    # check if there any zip files
-    files = os.listdir(directory)
-    for f in files:
-        if f.endswith('.zip'):
-            zip_file_path = os.path.join(directory, f)
-            with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
-                zip_ref.extractall(directory)
-            os.remove(zip_file_path)
-
-    # create paths to emails
-    for root, dirs, files in os.walk(directory, topdown=True):
-        for f in files:
-            email_file_path = os.path.join(root, f)
-            if not os.path.isfile(email_file_path):
-                raise RuntimeError(
-                    "Failed to find docs file {}".format(email_file_path))
-            else:
-                emails.append(email_file_path)
-    return emails
+            manifest_location = ctx.get("email_manifest") or "s3://{}/{}".format(s3_bucket, MANIFEST_KEY)
+            directory, objects = download_files_from_s3(s3_bucket, manifest_location)
+            manifest = (manifest_location, objects)
+
+    return directory, manifest
 
 
-def scrape_emails(email_file):
-    '''Extract order IDs and Download Links from emails'''
-    order_id = False
-    media_type = False
-    host = False
-    directory = False
-    download_link_index = False
+def scrape_email_batch(batch):
+    '''Extract the orders from a batch of (bytes, source) emails. returns the Orders found'''
+    orders = []
+    for data, source in batch:
+        order = scrape_email(data, source)
+        if order is not None:
+            orders.append(order)
+    return orders
+
+
+def scrape_email(data, source=None):
+    '''Extract the order ID and Download Link from the bytes of an email. returns an Order, or None'''
     try:
-        wd = os.getcwd()
-        tmp_file_path = os.path.join(wd, "tmp.txt")
-        print("file ends with .eml: {}".format(email_file))
-        with open(email_file, 'rb') as f:  # select a specific email file from the list
-            msg = BytesParser(policy=policy.default).parse(f)
-            text = msg.get_body(preferencelist=('plain')).get_content()
-            tmp_file = open(tmp_file_path, "w")
-            tmp_file.write(text)
-            tmp_file.close()
-        f.close()
-        email_file = tmp_file_path
-        with open(email_file, encoding='utf-8',
-                  errors='ignore') as f:
-            for i, line in enumerate(f):
-                if order_id and download_link_index:  # if order_id and download_link_index are true, exit function
-                    order = [order_id, download_link_index]
-                    print(order)
-                    f.close()
-                    return order
-                if "ORDERID" in line:  # extract order ID
-                    order_id = ''.join(list(filter(str.isdigit, line)))
-                if "MEDIATYPE:" in line:
-                    media_type = line.lower().split(': ')[-1]
-                    media_type = media_type.rstrip()
-                if "HOST:" in line:
-                    host = line.split(': ')[-1]
-                    host = host.rstrip()
-                if "DIR:" in line:
-                    directory = line.split(': ')[-1]
-                    directory = directory.rstrip()
-                if media_type and host and directory:
-                    download_link_index = "{}://{}{}".format(
-                        media_type, host, directory)
-    except:
-        print("could not find ORDERID and Download Links in email: {}".format(
-            email_file))
+        msg = BytesParser(policy=policy.default).parsebytes(data)
+        text = msg.get_body(preferencelist=('plain')).get_content()
+        order = parse_order(text, source)
+    except Exception:
+        order = None
+    if order is None:
+        print("could not find ORDERID and Download Links in email: {}".format(source))
+        return None
+    print(order)
+    return order
 
 
-def query_es(uid):
-    '''simple single elasticsearch query, used for existence. returns count of result.'''
-    mozart_ip = app.conf['JOBS_ES_URL']
+def parse_order(text, source=None):
+    '''Extract the order ID and Download Link from the plain text body of an email in one pass. returns an Order, or None'''
+    fields = {}
+    for match in ORDER_FIELDS.finditer(text):
+        fields.setdefault(match.group(1), match.group(2).strip())
+    order_id = ''.join(filter(str.isdigit, fields.get("ORDERID", "")))
+    media_type = fields.get("MEDIATYPE", "").lower()
+    host = fields.get("HOST")
+    directory = fields.get("DIR")
+    if not (order_id and media_type and host and directory):
+        return None
+    return Order(order_id, "{}://{}{}".format(media_type, host, directory), source)
+
+
+def query_existing_orders(order_ids):
+    '''returns the subset of order ids with a job in mozart that has not failed, querying ORDER_CHUNK ids at a time'''
     idx = "job_status-current"
-    mozart_url = '{0}/{1}/_search'.format(mozart_ip, idx)
-    es_query = {"query": {"bool": {"must": [{"query_string": {"default_field": "_all", "query": uid}}], "must_not": [{"query_string": {"default_field": "status", "query": "job-failed"}}
-                                                                                                                     ], "should": []}}, "from": 0, "size": 10, "sort": [], "aggs": {}}
-    print('querying: {} with {}'.format(mozart_url, es_query))
-    response = requests.post(
-        mozart_url, data=json.dumps(es_query), verify=False)
-    try:
-        response.raise_for_status()
-    except:
-        # if there is an error (or 404,just publish
-        return 0
-    text = response.text.encode('ascii')
-    results = json.loads(text)
-    #results_list = results.get('hits', {}).get('hits', [])
-    total_count = results.get('hits', {}).get('total', 0)
-    return int(total_count)
+    existing = set()
+    for i in range(0, len(order_ids), ORDER_CHUNK):
+        chunk = order_ids[i:i + ORDER_CHUNK]
+        es_query = {"query": {"bool": {"must": [{"query_string": {"default_field": "_all", "query": " OR ".join(chunk)}}], "must_not": [{"query_string": {"default_field": "status", "query": "job-failed"}}
+                                                                                                                                ], "should": []}}, "from": 0, "size": ES_MAX_SIZE, "sort": [], "aggs": {}}
+        hits = mozart().hits(idx, es_query)
+        # match the jobs back to the order ids they mention
+        patterns = dict((order_id, re.compile(r'\b{}\b'.format(re.escape(order_id)))) for order_id in chunk)
+        for hit in hits:
+            source = json.dumps(hit.get('_source', {}))
+            existing.update(order_id for order_id, pattern in patterns.items() if pattern.search(source))
+    print("{} of {} orders already have a job".format(len(existing), len(order_ids)))
+    return existing
 
 
-def download_files_from_s3(s3_bucket):
-    '''download emails from s3 bucket'''
+def download_files_from_s3(s3_bucket, manifest_location, workers=S3_WORKERS):
+    '''
+    download the emails from s3 bucket that are new or changed since the manifest at manifest_location,
+    workers at a time. returns the download directory and the manifest objects including them
+    '''
     try:
         # get work directory
         wd = os.getcwd()
         # create Downloads directory
         ava_email_dir = os.path.join(wd, "Downloads")
         os.mkdir(ava_email_dir)
-        os.chdir(ava_email_dir)
-        # initiate s3 resource
-        s3 = boto3.resource('s3')
-        # select bucket
-        ava_email_bucket = s3.Bucket(s3_bucket)
+        # initiate s3 client, which is shared by the download threads
+        s3 = boto3.client('s3')
+        objects = load_manifest(s3, manifest_location)
+        pending = []
+        for page in s3.get_paginator('list_objects_v2').paginate(Bucket=s3_bucket):
+            for s3_object in page.get('Contents', []):
+                key = s3_object['Key']
+                if key == MANIFEST_KEY or key.endswith('/'):
+                    continue
+                entry = {"etag": s3_object['ETag'], "last_modified": s3_object['LastModified'].isoformat()}
+                if objects.get(key) != entry:
+                    pending.append((key, entry))
+        print("{} new or changed emails in S3 bucket: {} ({} already processed)".format(len(pending), s3_bucket, len(objects)))
         # download file into Downloads directory
-        for s3_object in ava_email_bucket.objects.all():
-            filename = s3_object.key
-            ava_email_bucket.download_file(s3_object.key, filename)
-        os.chdir(wd)
-        return ava_email_dir
-    except:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(download_file_from_s3, s3, s3_bucket, key, ava_email_dir) for key, _ in pending]
+            for future in futures:
+                future.result()
+        objects.update(pending)
+        return ava_email_dir, objects
+    except Exception as e:
         raise Exception(
-            'unable to download emails from S3 bucket: {}'.format(s3_bucket))
+            'unable to download emails from S3 bucket: {} ({})'.format(s3_bucket, e))
+
+
+def download_file_from_s3(s3, s3_bucket, key, directory):
+    '''download one object from s3 bucket into directory'''
+    path = os.path.join(directory, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    s3.download_file(s3_bucket, key, path)
+
+
+def load_manifest(s3, location):
+    '''loads the key: {etag, last_modified} manifest of processed emails from an s3 url or a local path'''
+    if location.startswith('s3://'):
+        bucket, key = location[5:].split('/', 1)
+        try:
+            body = s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+        except s3.exceptions.NoSuchKey:
+            return {}
+        return json.loads(body.decode('utf-8'))
+    if not os.path.exists(location):
+        return {}
+    with open(location, 'r') as fin:
+        return json.load(fin)
+
+
+def save_manifest(location, objects):
+    '''saves the manifest of processed emails to an s3 url or a local path'''
+    body = json.dumps(objects, indent=2, sort_keys=True)
+    if location.startswith('s3://'):
+        bucket, key = location[5:].split('/', 1)
+        boto3.client('s3').put_object(Bucket=bucket, Key=key, Body=body.encode('utf-8'))
+    else:
+        tmp_path = '{}.tmp'.format(location)
+        with open(tmp_path, 'w') as outf:
+            outf.write(body)
+        os.replace(tmp_path, location)
+    print("saved manifest of {} processed emails to: {}".format(len(objects), location))
 
 
 def load_context():
@@ -203,6 +317,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--dir", required=False,
                         help="name of the directory containing LPDAAC emails")
+    parser.add_argument("-w", "--parse_workers", required=False, type=int,
+                        help="number of processes parsing emails (default: the parse_workers param, or {})".format(PARSE_WORKERS))
+    parser.add_argument("-r", "--submit_rate", required=False, type=float,
+                        help="max job submissions per second, 0 for no limit (default: the submit_rate param, or {})".format(SUBMIT_RATE))
     args = parser.parse_args()
 
     # run main funciton
@@ -0,0 +1,51 @@
+'''
+On-disk index of MET products known to be ingested on GRQ, so reruns of the
+AVA scrape can skip granules without querying the CMR or GRQ again.
+'''
+
+from __future__ import print_function
+import os
+import sqlite3
+import threading
+
+SQL_CHUNK = 500 # stays under the sqlite host parameter limit
+_lock = threading.Lock() # connections are shared between pipeline stages
+
+def open_index(path):
+    '''opens (creating if needed) the sqlite index at path and returns the connection'''
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute('CREATE TABLE IF NOT EXISTS ingested (uid TEXT PRIMARY KEY, granule_ur TEXT)')
+    conn.execute('CREATE INDEX IF NOT EXISTS ingested_granule_ur ON ingested (granule_ur)')
+    conn.commit()
+    return conn
+
+def add_to_index(conn, entries):
+    '''records the (uid, granule_ur) entries as ingested'''
+    with _lock:
+        conn.executemany('INSERT OR REPLACE INTO ingested (uid, granule_ur) VALUES (?, ?)', entries)
+        conn.commit()
+
+def known_granules(conn, granule_urs):
+    '''returns the subset of granule_urs recorded in the index'''
+    granule_urs = list(granule_urs)
+    found = set()
+    for i in range(0, len(granule_urs), SQL_CHUNK):
+        chunk = granule_urs[i:i + SQL_CHUNK]
+        sql = 'SELECT granule_ur FROM ingested WHERE granule_ur IN ({})'.format(','.join('?' * len(chunk)))
+        with _lock:
+            found.update(row[0] for row in conn.execute(sql, chunk))
+    return found
+
+def index_size(conn):
+    '''returns the number of products recorded in the index'''
+    with _lock:
+        return conn.execute('SELECT COUNT(*) FROM ingested').fetchone()[0]
+
+def clear_index(conn):
+    '''removes every entry from the index'''
+    with _lock:
+        conn.execute('DELETE FROM ingested')
+        conn.commit()
@@ -0,0 +1,173 @@
+'''
+Minimal threaded pipeline: stages joined by bounded queues, each stage with
+its own worker count, so a slow stage applies backpressure upstream instead
+of throttling every other stage.
+'''
+
+from __future__ import print_function
+import time
+import threading
+import logging as logger
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+_DONE = object() # end of stream marker
+POLL_INTERVAL = 0.5 # seconds between abort checks while blocked on a queue
+
+class PipelineAborted(Exception):
+    '''raised inside workers when another stage has failed'''
+
+class Stage(object):
+    '''
+    A pipeline stage. func is called with each item, or with a list of up to
+    batch_size items when batch_size is set, and returns an iterable of items
+    to pass downstream (empty to drop the input).
+    '''
+    def __init__(self, name, func, workers=1, queue_size=100, batch_size=None, linger=1.0):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.batch_size = batch_size
+        self.linger = linger
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.items_in = 0
+        self.items_out = 0
+        self.busy = 0.0
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+        self._active = workers
+
+    def report(self):
+        '''returns a one line summary of the stage throughput'''
+        elapsed = (self.finished or time.time()) - (self.started or time.time())
+        rate = self.items_in / elapsed if elapsed > 0 else 0.0
+        return '{}: {} in, {} out, {} workers, {:.1f}s elapsed, {:.1f}s busy, {:.2f} items/s'.format(
+            self.name, self.items_in, self.items_out, self.workers, elapsed, self.busy, rate)
+
+class Pipeline(object):
+    '''runs items from a source iterable through a list of stages'''
+    def __init__(self, stages):
+        self.stages = stages
+        self.source_count = 0
+        self._error = None
+        self._abort = threading.Event()
+
+    def run(self, source):
+        '''feeds source through every stage and blocks until all items are processed. re-raises the first stage error'''
+        threads = [threading.Thread(target=self._feed, args=(source,), name='pipeline-source')]
+        for i, stage in enumerate(self.stages):
+            downstream = self.stages[i + 1] if i + 1 < len(self.stages) else None
+            for n in range(stage.workers):
+                threads.append(threading.Thread(target=self._work, args=(stage, downstream),
+                                                name='pipeline-{}-{}'.format(stage.name, n)))
+        start = time.time()
+        for stage in self.stages:
+            stage.started = start
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def report(self):
+        '''logs the per-stage throughput counters'''
+        logger.info('pipeline source: {} items'.format(self.source_count))
+        for stage in self.stages:
+            logger.info('pipeline {}'.format(stage.report()))
+
+    def _fail(self, error):
+        '''records the first error and stops every stage'''
+        if self._error is None:
+            self._error = error
+        self._abort.set()
+
+    def _put(self, stage, item):
+        '''blocking put that gives up once the pipeline is aborted'''
+        while True:
+            if self._abort.is_set():
+                raise PipelineAborted()
+            try:
+                stage.queue.put(item, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, stage, timeout=None):
+        '''blocking get that gives up once the pipeline is aborted. raises queue.Empty after timeout if given'''
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if self._abort.is_set():
+                raise PipelineAborted()
+            wait = POLL_INTERVAL if deadline is None else min(POLL_INTERVAL, deadline - time.time())
+            if wait <= 0:
+                raise queue.Empty()
+            try:
+                return stage.queue.get(timeout=wait)
+            except queue.Empty:
+                continue
+
+    def _feed(self, source):
+        '''puts every source item on the first stage'''
+        first = self.stages[0]
+        try:
+            for item in source:
+                self.source_count += 1
+                self._put(first, item)
+            for _ in range(first.workers):
+                self._put(first, _DONE)
+        except PipelineAborted:
+            pass
+        except Exception as e:
+            self._fail(e)
+
+    def _work(self, stage, downstream):
+        '''worker loop for one stage'''
+        try:
+            finished = False
+            while not finished:
+                item = self._get(stage)
+                if item is _DONE:
+                    break
+                if stage.batch_size:
+                    batch = [item]
+                    while len(batch) < stage.batch_size:
+                        try:
+                            item = self._get(stage, timeout=stage.linger)
+                        except queue.Empty:
+                            break
+                        if item is _DONE:
+                            finished = True
+                            break
+                        batch.append(item)
+                    payload = batch
+                else:
+                    payload = item
+                    batch = [item]
+                start = time.time()
+                outputs = list(stage.func(payload) or [])
+                with stage._lock:
+                    stage.items_in += len(batch)
+                    stage.items_out += len(outputs)
+                    stage.busy += time.time() - start
+                if downstream is not None:
+                    for output in outputs:
+                        self._put(downstream, output)
+            # the last worker out signals the next stage
+            with stage._lock:
+                stage._active -= 1
+                last = stage._active == 0
+            if last:
+                stage.finished = time.time()
+                if downstream is not None:
+                    for _ in range(downstream.workers):
+                        self._put(downstream, _DONE)
+        except PipelineAborted:
+            pass
+        except Exception as e:
+            logger.error('pipeline stage {} failed: {}'.format(stage.name, e))
+            self._fail(e)
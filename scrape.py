@@ -12,10 +12,19 @@ import urllib3
 import dateutil.parser
 import logging as logger
 import requests
+from requests.adapters import HTTPAdapter
 import csv
+from itertools import islice
+import threading
+from functools import partial
 from hysds.celery import app
 from hysds.dataset_ingest import ingest
 import hysds.orchestrator
+from submit_job import main as submit_job
+from pipeline import Pipeline, Stage
+from es_client import grq, grq_batcher, total
+from acquisition_key import acquisition_key
+from ingested_index import open_index, add_to_index, known_granules, index_size, clear_index
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -24,6 +33,29 @@ PROD = "MET-{}-{}-{}"
 PROD_TYPE = "grq_{}_metadata-{}"
 CMR_URL = 'https://cmr.earthdata.nasa.gov/search/granules.json?granule_ur={}&provider-id=LPDAAC_ECS'
 AVA_URL = 'https://ava.jpl.nasa.gov/retrieve/list_{}.php?year={}' # example: https://ava.jpl.nasa.gov/retrieve/list_AST_L1B.php?year=2000
+CMR_BATCH_URL = 'https://cmr.earthdata.nasa.gov/search/granules.json?provider-id=LPDAAC_ECS&page_size={}&scroll=true'
+CMR_WORKERS = 8 # default number of concurrent CMR lookups
+PUBLISH_WORKERS = 1
+QUEUE_SIZE = 1000 # max items waiting between pipeline stages
+CMR_ATTEMPTS = 3
+CMR_MAX_PAGE_SIZE = 2000
+ES_TERMS_CHUNK = 500 # max ids per bulk existence query
+ES_SCROLL_SIZE = 1000
+INDEX_MODES = ['use', 'seed', 'refresh']
+CHECKPOINT_FILE = 'scrape_checkpoint.json'
+CHECKPOINT_INTERVAL = 1000 # AVA rows processed between checkpoints
+MISSING_CSV = 'missing_lp_daac_id_products.csv'
+AVA_TIMEOUT = 450
+AVA_STREAM_CHUNK = 64 * 1024
+REPORT_FILE = 'scrape_report.json'
+# fan out job specs
+JOB_NAME = "job-ingest_ava_met"
+JOB_VERSION = "master"
+QUEUE = "factotum-job_worker-small"
+PRIORITY = 5
+RUN_TAG = "ingest_ava_met-{}-{}_{}" # e.g. ingest_ava_met-AST_L1B-2000_2018
+SHARD_PARAMS = ["cmr_workers", "cmr_batch_size", "ingested_index", "ingested_index_mode", "checkpoint_path", "checkpoint_interval", "resume",
+                "stream_ava", "publish_workers", "queue_size"]
 
 def main():
     '''
@@ -35,12 +67,6 @@ def main():
                        filemode='w',
                        level=logger.INFO)
 
-    # Create missing LP_DAAC ID product csv file
-    mp_csv = open("missing_lp_daac_id_products.csv", "w")
-    header = ["missing_lp_daac_id_products", "ava_product_url"]
-    mp_writer = csv.DictWriter(mp_csv, fieldnames=header)
-    mp_writer.writeheader()
-
     # load parameters
     ctx = load_context()
     shortname = ctx.get("short_name", False)
@@ -54,67 +80,448 @@ def main():
         raise Exception("end_year must be specified.")
     if end_year < start_year:
         raise Exception("end_year must be greater than or equal to start_year")
+    cmr_workers = int(ctx.get("cmr_workers") or CMR_WORKERS)
+    if cmr_workers < 1:
+        raise Exception("cmr_workers must be at least 1.")
+    cmr_batch_size = int(ctx.get("cmr_batch_size") or 0)
+    if cmr_batch_size > CMR_MAX_PAGE_SIZE:
+        raise Exception("cmr_batch_size must be at most {}.".format(CMR_MAX_PAGE_SIZE))
+    checkpoint_path = ctx.get("checkpoint_path") or CHECKPOINT_FILE
+    checkpoint_interval = int(ctx.get("checkpoint_interval") or CHECKPOINT_INTERVAL)
+    if checkpoint_interval < 1:
+        raise Exception("checkpoint_interval must be at least 1.")
+    stream_ava = get_flag(ctx, "stream_ava")
+    publish_workers = int(ctx.get("publish_workers") or PUBLISH_WORKERS)
+    if publish_workers < 1:
+        raise Exception("publish_workers must be at least 1.")
+    queue_size = int(ctx.get("queue_size") or QUEUE_SIZE)
+    row_start = int(ctx.get("row_start") or 0)
+    row_end = int(ctx.get("row_end")) if ctx.get("row_end") not in (None, '') else None
+    if (row_start or row_end is not None) and start_year != end_year:
+        raise Exception("row_start and row_end require start_year and end_year to be the same year")
+
+    # submit one job per shard instead of scraping here. each shard opens and seeds its own ingested index
+    if get_flag(ctx, "fan_out"):
+        fan_out(ctx, shortname, start_year, end_year, int(ctx.get("year_splits") or 1))
+        return
+    index = load_ingested_index(ctx, shortname)
+    session = get_session(pool_size=cmr_workers)
+
+    # pick up from the last checkpoint if resuming
+    checkpoint = {"short_name": shortname, "start_year": start_year, "end_year": end_year, "row_start": row_start, "row_end": row_end,
+                  "year": start_year, "offset": row_start, "total_granules": 0, "ingested_granules": 0, "non_ingested_granules": 0}
+    resumed = False
+    if get_flag(ctx, "resume"):
+        saved = load_checkpoint(checkpoint_path)
+        if saved is None:
+            logger.info('No checkpoint found at {}. Starting from the beginning.'.format(checkpoint_path))
+        elif [saved.get(k) for k in ("short_name", "start_year", "end_year", "row_start", "row_end")] != [shortname, start_year, end_year, row_start, row_end]:
+            raise Exception("checkpoint {} is for a different short_name, year range or row range".format(checkpoint_path))
+        else:
+            checkpoint = saved
+            resumed = True
+            logger.info('Resuming from year {} row {}'.format(checkpoint["year"], checkpoint["offset"]))
+
+    # Create missing LP_DAAC ID product csv file, appending to it when resuming
+    header = ["missing_lp_daac_id_products", "ava_product_url"]
+    if resumed and os.path.exists(MISSING_CSV):
+        mp_csv = open(MISSING_CSV, "a")
+        mp_writer = csv.DictWriter(mp_csv, fieldnames=header)
+    else:
+        mp_csv = open(MISSING_CSV, "w")
+        mp_writer = csv.DictWriter(mp_csv, fieldnames=header)
+        mp_writer.writeheader()
 
-    # Iterate from start_year to end_year
-    total_granules=0
-    ingested_granules=0
-    non_ingested_granules=0
+    # run the AVA listing, CMR resolution, existence check and publish as a staged pipeline
+    progress = ScrapeProgress(checkpoint, checkpoint_path, checkpoint_interval, mp_csv, mp_writer)
+    if cmr_batch_size:
+        resolve = Stage('cmr', partial(resolve_granule_batch, session=session, shortname=shortname, progress=progress),
+                        workers=cmr_workers, queue_size=queue_size, batch_size=cmr_batch_size)
+    else:
+        resolve = Stage('cmr', partial(resolve_granule, session=session, shortname=shortname, progress=progress),
+                        workers=cmr_workers, queue_size=queue_size)
+    stages = [
+        Stage('filter', partial(filter_rows, index=index, progress=progress),
+              queue_size=queue_size, batch_size=ES_TERMS_CHUNK),
+        resolve,
+        Stage('exists', partial(check_products, shortname=shortname, index=index, progress=progress, claimed=set()),
+              queue_size=queue_size, batch_size=ES_TERMS_CHUNK),
+        Stage('publish', partial(publish_product, index=index, progress=progress),
+              workers=publish_workers, queue_size=queue_size),
+    ]
+    pipeline = Pipeline(stages)
+    try:
+        pipeline.run(iter_ava_rows(shortname, checkpoint["year"], end_year, checkpoint["offset"], stream_ava, progress, row_end))
+        # mark the run as complete, while the missing products csv is still open
+        progress.save()
+    finally:
+        pipeline.report()
+        mp_csv.close()
+        if index is not None:
+            index.close()
+    # Calculate number of granules ingested
+    ingested_granules = progress.checkpoint["ingested_granules"]
+    non_ingested_granules = progress.checkpoint["non_ingested_granules"]
+    total_granules = progress.checkpoint["total_granules"]
+    logger.info("{} granules ingested out of {} between the years {} to {}".format(ingested_granules, total_granules, start_year, end_year))
+    logger.info("{} granules NOT ingested out of {} between the years {} to {}".format(non_ingested_granules, total_granules, start_year, end_year))
+    save_report(REPORT_FILE, progress.checkpoint)
+
+def fan_out(ctx, shortname, start_year, end_year, year_splits):
+    '''submits one ingest_ava_met job per year, or per row range of a year when year_splits > 1'''
+    run_tag = RUN_TAG.format(shortname, start_year, end_year)
+    job_version = ctx.get("job_version") or JOB_VERSION
+    queue = ctx.get("shard_queue") or QUEUE
+    base_params = dict((k, ctx[k]) for k in SHARD_PARAMS if ctx.get(k) not in (None, ''))
+    shards = 0
     for year in range(start_year, (end_year+1)):
+        for row_start, row_end in shard_rows(shortname, year, year_splits):
+            params = dict(base_params, short_name=shortname, start_year=year, end_year=year)
+            shard_tag = '{}-{}'.format(run_tag, year)
+            if (row_start, row_end) != (0, None):
+                params["row_start"] = row_start
+                if row_end is not None:
+                    params["row_end"] = row_end
+                shard_tag = '{}-rows_{}_{}'.format(shard_tag, row_start, 'end' if row_end is None else row_end)
+            # shards must not share a checkpoint or an ingested index, which may be on different hosts
+            for key in ("checkpoint_path", "ingested_index"):
+                if base_params.get(key):
+                    params[key] = '{}.{}'.format(base_params[key], shard_tag)
+            logger.info('Submitting shard: {}'.format(shard_tag))
+            submit_job(JOB_NAME, params, job_version, queue, PRIORITY, '{},{}'.format(run_tag, shard_tag))
+            shards += 1
+    logger.info('Submitted {} shards tagged {}'.format(shards, run_tag))
+    print('Submitted {} shards tagged {}'.format(shards, run_tag))
+
+def shard_rows(shortname, year, year_splits):
+    '''
+    returns the (row_start, row_end) ranges to split a year into. (0, None) covers the whole year. the last
+    range is open ended, so rows the AVA adds after the split are still processed
+    '''
+    if year_splits <= 1:
+        return [(0, None)]
+    count = len(list_ava_rows(AVA_URL.format(shortname, year)))
+    bounds = [count * i // year_splits for i in range(year_splits + 1)]
+    ranges = [(bounds[i], bounds[i + 1]) for i in range(year_splits) if bounds[i] < bounds[i + 1]]
+    if not ranges:
+        return [(0, None)]
+    ranges[-1] = (ranges[-1][0], None)
+    return ranges
+
+def save_report(path, checkpoint):
+    '''writes the counts for this job, for aggregate_scrape_reports.py'''
+    keys = ["short_name", "start_year", "end_year", "row_start", "row_end", "total_granules", "ingested_granules", "non_ingested_granules"]
+    report = dict((k, checkpoint.get(k)) for k in keys)
+    report["missing_csv"] = MISSING_CSV
+    with open(path, 'w') as outf:
+        json.dump(report, outf)
+
+def iter_ava_rows(shortname, first_year, end_year, offset, stream_ava, progress, row_end=None):
+    '''pipeline source. yields an item per AVA row from first_year (starting at row offset) to end_year, stopping the last year at row_end'''
+    for year in range(first_year, (end_year+1)):
         #query the ava
         ava_url = AVA_URL.format(shortname, year)
         logger.info('Querying AVA for year({}) and product({}) from: {}'.format(year, shortname, ava_url))
         print('Querying AVA for year({}) and product({}) from: {}'.format(year, shortname, ava_url))
-        #ave returns a very simple json
-        response = requests.get(ava_url, timeout=450, verify=False)
-        response.raise_for_status()
-        ava_gran_dct = json.loads(response.text)
-        logger.info('AVA returned {} items.'.format(len(ava_gran_dct)))
-        print('AVA returned {} items.'.format(len(ava_gran_dct)))
-        total_granules += len(ava_gran_dct)
-
-        #for each item, see if it's been ingested. if it has query the CMR and get the metadata
-        for row in ava_gran_dct:
-            granule_ur = row['id']
-            product_url = row['path']
-            if not granule_ur: # If LP_DAAC ID is None, log missing product
-                product = product_url.split('/')[-1]
-                logger.error("Missing LP DAAC ID for : {}".format(product_url))
-                mp_writer.writerows([{"missing_lp_daac_id_products": product, "ava_product_url": product_url}])
-                non_ingested_granules += 1
+        if stream_ava:
+            ava_rows = stream_ava_rows(ava_url)
+        else:
+            ava_rows = list_ava_rows(ava_url)
+        # rows before the checkpoint offset were already processed
+        for row in islice(ava_rows, offset, row_end if year == end_year else None):
+            yield {"year": year, "offset": offset, "row": row}
+            offset += 1
+        progress.year_listed(year, offset)
+        offset = 0
+
+def list_ava_rows(ava_url):
+    '''queries the AVA listing and returns all rows at once'''
+    #ave returns a very simple json
+    response = requests.get(ava_url, timeout=AVA_TIMEOUT, verify=False)
+    response.raise_for_status()
+    ava_gran_dct = json.loads(response.text)
+    logger.info('AVA returned {} items.'.format(len(ava_gran_dct)))
+    print('AVA returned {} items.'.format(len(ava_gran_dct)))
+    return ava_gran_dct
+
+def stream_ava_rows(ava_url):
+    '''streams the AVA listing, yielding each row as soon as it has been received'''
+    response = requests.get(ava_url, timeout=AVA_TIMEOUT, verify=False, stream=True)
+    response.raise_for_status()
+    if response.encoding is None:
+        response.encoding = 'utf-8'
+    count = 0
+    try:
+        for row in iter_json_array(response.iter_content(chunk_size=AVA_STREAM_CHUNK, decode_unicode=True)):
+            count += 1
+            yield row
+    finally:
+        response.close()
+    logger.info('AVA returned {} items.'.format(count))
+    print('AVA returned {} items.'.format(count))
+
+def iter_json_array(chunks):
+    '''incrementally decodes a top level json array from text chunks, yielding each element once it is complete'''
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    started = False
+    for chunk in chunks:
+        buf = buf[pos:] + chunk
+        pos = 0
+        while True:
+            # skip whitespace and separators between elements
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buf):
+                break
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError('expected a json array')
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                element, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # element is incomplete, wait for more data
+                break
+            if end == len(buf) and not isinstance(element, (dict, list)):
+                # a scalar at the end of the buffer may be truncated
+                break
+            yield element
+            pos = end
+    raise ValueError('incomplete json array')
+
+def filter_rows(items, index, progress):
+    '''pipeline stage. drops rows without an LP DAAC ID (logging them as missing) and rows already in the ingested index'''
+    rows = []
+    for item in items:
+        if not item['row']['id']: # If LP_DAAC ID is None, log missing product
+            progress.missing_id(item)
+        else:
+            rows.append(item)
+    if index is not None:
+        known = known_granules(index, [item['row']['id'] for item in rows])
+        if known:
+            logger.info('Skipping {} granules already in the ingested index.'.format(len(known)))
+            for item in rows:
+                if item['row']['id'] in known:
+                    progress.done(item, 'skipped')
+            rows = [item for item in rows if item['row']['id'] not in known]
+    return rows
+
+def resolve_granule(item, session, shortname, progress):
+    '''pipeline stage. queries the CMR for a single row and generates its product'''
+    return attach_products([(item, query_cmr(session, item['row']['id']))], shortname, progress)
+
+def resolve_granule_batch(items, session, shortname, progress):
+    '''pipeline stage. queries the CMR for a batch of rows at once and generates their products'''
+    results = query_cmr_batch(session, [item['row'] for item in items])
+    return attach_products([(item, granule) for item, (_, granule) in zip(items, results)], shortname, progress)
+
+def attach_products(resolved, shortname, progress):
+    '''generates the product for each (item, granule), logging items with no CMR data as missing'''
+    items = []
+    for item, granule in resolved:
+        if granule is None:
+            logger.error("Missing CMR data for : {}".format(CMR_URL.format(item['row']['id'])))
+            progress.done(item, 'non_ingested')
+            continue
+        granule['ava_url'] = item['row']['path']
+        granule['on_ava'] = True
+        granule['short_name'] = shortname
+        try:
+            ds, met = gen_product(granule, shortname)
+        except (IndexError, KeyError):
+            # eg no polygons
+            logger.error("Missing CMR data for : {}".format(CMR_URL.format(item['row']['id'])))
+            progress.done(item, 'non_ingested')
+            continue
+        item.update({"uid": ds.get('label'), "ds": ds, "met": met})
+        items.append(item)
+    return items
+
+def check_products(items, shortname, index, progress, claimed):
+    '''pipeline stage. drops products that already exist on grq or are already being published'''
+    existing = exists_bulk([item['uid'] for item in items], PROD_TYPE.format(VERSION, shortname))
+    if index is not None and existing:
+        add_to_index(index, [(item['uid'], item['row']['id']) for item in items if item['uid'] in existing])
+    publish = []
+    for item in items:
+        # guard against the same granule being listed twice
+        if item['uid'] in existing or item['uid'] in claimed:
+            progress.done(item, 'skipped')
+            continue
+        claimed.add(item['uid'])
+        publish.append(item)
+    return publish
+
+def publish_product(item, index, progress):
+    '''pipeline stage. publishes a single product'''
+    uid = item['uid']
+    logger.info('ingesting: {}'.format(uid))
+    ingest_product(uid, item['ds'], item['met'], check_exists=False)
+    if index is not None:
+        add_to_index(index, [(uid, item['row']['id'])])
+    progress.done(item, 'ingested')
+    return []
+
+class ScrapeProgress(object):
+    '''
+    Tracks which AVA rows have finished the pipeline. Rows complete out of order,
+    so the checkpoint only advances over the contiguous run of finished rows, and
+    the counters only include rows behind it.
+    '''
+    def __init__(self, checkpoint, path, interval, mp_csv, mp_writer):
+        self.checkpoint = dict(checkpoint)
+        self.path = path
+        self.interval = interval
+        self.mp_csv = mp_csv
+        self.mp_writer = mp_writer
+        self.finished = {} # (year, offset) -> outcome for rows ahead of the checkpoint
+        self.year_rows = {} # year -> number of rows listed
+        self.unsaved = 0
+        self.lock = threading.Lock()
+
+    def missing_id(self, item):
+        '''logs a row without an LP DAAC ID to the missing products csv'''
+        product_url = item['row']['path']
+        product = product_url.split('/')[-1]
+        logger.error("Missing LP DAAC ID for : {}".format(product_url))
+        with self.lock:
+            self.mp_writer.writerows([{"missing_lp_daac_id_products": product, "ava_product_url": product_url}])
+        self.done(item, 'non_ingested')
+
+    def done(self, item, outcome):
+        '''marks a row as finished with outcome ingested, non_ingested or skipped'''
+        with self.lock:
+            self.finished[(item['year'], item['offset'])] = outcome
+            self._advance()
+
+    def year_listed(self, year, rows):
+        '''records the number of rows in a year's listing, so the checkpoint can move past it'''
+        with self.lock:
+            self.year_rows[year] = rows
+            self._advance()
+
+    def save(self):
+        '''writes the current checkpoint'''
+        with self.lock:
+            self._save()
+
+    def _advance(self):
+        '''moves the checkpoint over finished rows and saves it every interval rows'''
+        checkpoint = self.checkpoint
+        while True:
+            key = (checkpoint["year"], checkpoint["offset"])
+            if key in self.finished:
+                outcome = self.finished.pop(key)
+                checkpoint["offset"] += 1
+                checkpoint["total_granules"] += 1
+                if outcome == 'ingested':
+                    checkpoint["ingested_granules"] += 1
+                elif outcome == 'non_ingested':
+                    checkpoint["non_ingested_granules"] += 1
+                self.unsaved += 1
+            elif self.year_rows.get(checkpoint["year"]) == checkpoint["offset"]:
+                checkpoint["year"] += 1
+                checkpoint["offset"] = 0
             else:
-                cmr_url = CMR_URL.format(granule_ur)
-                # Attempt to access CMR
-                attempts = 0
-                while attempts < 3:
-                    try:
-                        response = requests.get(cmr_url, timeout=60)
-                        response.raise_for_status()
-                        logger.info("CMR URL: {} returned status code: {}".format(cmr_url, response.status_code))
-                        break
-                    except requests.exceptions.ReadTimeout as e:
-                        attempts += 1
-                        print("CMR Timeout Error: %s" % e)
-                try:
-                    granule = json.loads(response.text)["feed"]["entry"][0]
-                    granule['ava_url'] = product_url
-                    granule['on_ava'] = True
-                    granule['short_name'] = shortname
-                    ds, met = gen_product(granule, shortname)
-                    uid = ds.get('label')
-                    logger.info('ingesting: {}'.format(uid))
-                    if exists(uid, shortname):
-                        continue
-                    #save_product_met(uid, ds, met)
-                    ingest_product(uid, ds, met)
-                    ingested_granules += 1
-                    logger.info("{} of {} granules ingested".format(ingested_granules, total_granules))
-                except IndexError:
-                    logger.error("Missing CMR data for : {}".format(cmr_url))
-                    non_ingested_granules += 1
-    # Calculate number of granules ingested
-    logger.info("{} granules ingested out of {} between the years {} to {}".format(ingested_granules, total_granules, start_year, end_year))
-    logger.info("{} granules NOT ingested out of {} between the years {} to {}".format(non_ingested_granules, total_granules, start_year, end_year))
-    mp_csv.close()
+                break
+        if self.unsaved >= self.interval:
+            self._save()
+            logger.info("{} of {} granules ingested".format(checkpoint["ingested_granules"], checkpoint["total_granules"]))
+
+    def _save(self):
+        '''flushes the missing products csv and writes the checkpoint'''
+        self.mp_csv.flush()
+        save_checkpoint(self.path, self.checkpoint)
+        self.unsaved = 0
+
+def load_checkpoint(path):
+    '''loads the checkpoint at path. returns None if there is none'''
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as fin:
+        return json.load(fin)
+
+def save_checkpoint(path, checkpoint):
+    '''atomically writes the checkpoint to path'''
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as outf:
+        json.dump(checkpoint, outf)
+        outf.flush()
+        os.fsync(outf.fileno())
+    os.replace(tmp_path, path)
+
+def load_ingested_index(ctx, shortname):
+    '''opens the ingested index given by the ingested_index param, seeding it from grq as requested. returns None if not configured'''
+    path = ctx.get("ingested_index", False)
+    if not path:
+        return None
+    mode = ctx.get("ingested_index_mode") or 'use'
+    if mode not in INDEX_MODES:
+        raise Exception("ingested_index_mode must be one of: {}".format(', '.join(INDEX_MODES)))
+    index = open_index(path)
+    if mode == 'refresh':
+        logger.info('Clearing ingested index: {}'.format(path))
+        clear_index(index)
+    if mode == 'refresh' or (mode == 'seed' and index_size(index) == 0):
+        logger.info('Seeding ingested index: {} from grq'.format(path))
+        for entries in scroll_ingested(PROD_TYPE.format(VERSION, shortname)):
+            add_to_index(index, entries)
+    logger.info('Ingested index {} holds {} products.'.format(path, index_size(index)))
+    return index
+
+def query_cmr(session, granule_ur):
+    '''queries the CMR for a single granule_ur. returns the granule entry, or None if the CMR has no data for it'''
+    cmr_url = CMR_URL.format(granule_ur)
+    # Attempt to access CMR
+    attempts = 0
+    while attempts < CMR_ATTEMPTS:
+        try:
+            response = session.get(cmr_url, timeout=60)
+            response.raise_for_status()
+            logger.info("CMR URL: {} returned status code: {}".format(cmr_url, response.status_code))
+            break
+        except requests.exceptions.ReadTimeout as e:
+            attempts += 1
+            print("CMR Timeout Error: %s" % e)
+    else:
+        return None
+    try:
+        return json.loads(response.text)["feed"]["entry"][0]
+    except IndexError:
+        return None
+
+def query_cmr_batch(session, rows):
+    '''queries the CMR for all granule_urs in rows at once. returns a list of (row, granule), with granule None if the CMR has no data for it'''
+    query_url = CMR_BATCH_URL.format(len(rows))
+    data = {'granule_ur[]': [row['id'] for row in rows]}
+    attempts = 0
+    while True:
+        try:
+            entries = run_query(query_url, session=session, data=data)
+            break
+        except requests.exceptions.ReadTimeout as e:
+            attempts += 1
+            print("CMR Timeout Error: %s" % e)
+            if attempts >= CMR_ATTEMPTS:
+                return [(row, None) for row in rows]
+    # join the entries back to the AVA rows by granule_ur (title) or producer_granule_id
+    granules = {}
+    for entry in entries:
+        for key in ('title', 'producer_granule_id'):
+            if entry.get(key):
+                granules[entry[key]] = entry
+    results = []
+    for row in rows:
+        granule = granules.get(row['id'])
+        results.append((row, dict(granule) if granule else None))
+    return results
 
 def gen_temporal_str(starttime, endtime):
     '''generates the temporal string for the cmr query'''
@@ -165,6 +572,9 @@ def gen_product(result, shortname):
     met = result
     met['shortname'] = shortname
     met['short_name'] = shortname
+    key = acquisition_key(shortname, result.get('producer_granule_id'))
+    if key:
+        met['acquisition_key'] = key
     return ds, met
 
 def gen_prod_id(shortname, starttime, endtime):
@@ -174,12 +584,12 @@ def gen_prod_id(shortname, starttime, endtime):
     time_str = '{}_{}'.format(start, end)
     return PROD.format(shortname, time_str, VERSION)
 
-def ingest_product(uid, ds, met):
+def ingest_product(uid, ds, met, check_exists=True):
     '''publish a product directly'''
     shortname = met.get('short_name', False)
     save_product_met(uid, ds, met)
     ds_dir = os.path.join(os.getcwd(), uid)
-    if exists(uid, shortname):
+    if check_exists and exists(uid, shortname):
         logger.info('Product already exists with uid: {}. Passing on publish...'.format(uid))
         return
     logger.info('Product with uid: {} does not exist. Publishing...'.format(uid))
@@ -198,14 +608,19 @@ def parse_location(result):
     location = {"type": "Polygon", "coordinates": coords}
     return location
 
-def get_session(verbose=False):
-    '''returns a CMR requests session'''
+def get_session(verbose=False, pool_size=None):
+    '''returns a CMR requests session. pool_size sizes the keep-alive connection pool for concurrent use'''
+    session = requests.Session()
+    if pool_size:
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
     #user = os.getenv('CMR_USERNAME')
     #passwd = os.getenv('CMR_PASSWORD')
     #if user is None or passwd is None:
     #    if verbose > 1:
     #        print ("Environment username & password not found")
-    return requests.Session()
+    return session
     #token_url = os.path.join(cmr_url, 'legacy-services/rest/tokens')
     #if verbose: print('token_url: %s' % token_url)
     #headers = {'content-type': 'application/json'}
@@ -221,21 +636,26 @@ def get_session(verbose=False):
     #if verbose: print("using session token:".format(token))
     #return session
 
-def run_query(query_url, verbose=False):
-    """runs a scrolling query over the given url and returns the result as a dictionary"""
+def run_query(query_url, verbose=False, session=None, data=None):
+    """runs a scrolling query over the given url and returns the result as a dictionary. data is POSTed as form parameters if given"""
     #if verbose:
     #    print('querying url: {0}'.format(query_url))
     granule_list = []
-    session = get_session(verbose=verbose)
+    if session is None:
+        session = get_session(verbose=verbose)
+    if data is None:
+        request = session.get
+    else:
+        request = lambda url, **kwargs: session.post(url, data=data, **kwargs)
     #initial query
-    response = session.get(query_url)
+    response = request(query_url, timeout=60)
     response.raise_for_status()
     granule_list.extend(json.loads(response.text)["feed"]["entry"])
     #get headers for scrolling
     tot_granules = response.headers["CMR-Hits"]
-    scroll_id = response.headers["CMR-Scroll-Id"]
+    scroll_id = response.headers.get("CMR-Scroll-Id")
     headers = {'CMR-Scroll-Id' : scroll_id}
-    if len(granule_list) is 0:
+    if len(granule_list) == 0:
         if verbose > 0:
             logger.info('no granules returned')
         return []
@@ -250,7 +670,7 @@ def run_query(query_url, verbose=False):
     for i in range(1, pages):
         if verbose > 1:
             logger.info("querying page {0}".format(i+1))
-        response = session.get(query_url, headers=headers)
+        response = request(query_url, headers=headers, timeout=60)
         response.raise_for_status()
         granule_returns = json.loads(response.text)["feed"]["entry"]
         if verbose > 1:
@@ -281,24 +701,34 @@ def save_product_met(prod_id, ds_obj, met_obj):
 
 def exists(uid, shortname):
     '''queries grq to see if the input id exists. Returns True if it does, False if not'''
-    grq_ip = app.conf['GRQ_ES_URL']#.replace(':9200', '').replace('http://', 'https://')
-    grq_url = '{0}/{1}/_search'.format(grq_ip, PROD_TYPE.format(VERSION, shortname))
     es_query = {"query":{"bool":{"must":[{"term":{"id.raw":uid}}]}},"from":0,"size":1}
-    return query_es(grq_url, es_query)
+    # batched with the checks of the other publish workers
+    return total(grq_batcher().search(PROD_TYPE.format(VERSION, shortname), es_query).result())
 
-def query_es(grq_url, es_query):
-    '''simple single elasticsearch query, used for existence. returns count of result.'''
-    logger.info('querying: {} with {}'.format(grq_url, es_query))
-    response = requests.post(grq_url, data=json.dumps(es_query), verify=False)
-    try:
-        response.raise_for_status()
-    except:
-        # if there is an error (or 404,just publish
-        return 0
-    results = json.loads(response.text, encoding='ascii')
-    #results_list = results.get('hits', {}).get('hits', [])
-    total_count = results.get('hits', {}).get('total', 0)
-    return int(total_count)
+def exists_bulk(uids, idx):
+    '''queries grq for the input ids in chunks of ES_TERMS_CHUNK, sent as one _msearch. Returns the set of ids that exist in idx'''
+    uids = list(uids)
+    batcher = grq_batcher()
+    futures = []
+    for i in range(0, len(uids), ES_TERMS_CHUNK):
+        chunk = uids[i:i + ES_TERMS_CHUNK]
+        es_query = {"query":{"terms":{"id.raw":chunk}},"_source":["id"],"from":0,"size":len(chunk)}
+        futures.append(batcher.search(idx, es_query))
+    batcher.flush()
+    found = set()
+    for future in futures:
+        found.update(hit.get('_source', {}).get('id', hit.get('_id')) for hit in future.result().get('hits', {}).get('hits', []))
+    return found
+
+def scroll_ingested(idx):
+    '''scrolls through every product in idx. yields lists of (uid, granule_ur) per page'''
+    es_query = {"query":{"match_all":{}},"_source":["id","metadata.title"],"size":ES_SCROLL_SIZE}
+    for hits in grq().scroll(idx, es_query):
+        yield [(hit['_source'].get('id', hit['_id']), hit['_source'].get('metadata', {}).get('title')) for hit in hits]
+
+def get_flag(ctx, name):
+    '''returns a boolean context param, which may arrive as a bool or a string'''
+    return str(ctx.get(name, False)).lower() == 'true'
 
 def load_context():
     '''loads the context file into a dict'''
@@ -7,10 +7,21 @@ Submits a standard job via a REST call
 from __future__ import print_function
 import os
 import json
+import time
+import random
 import argparse
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from hysds.celery import app
 
+SUBMIT_WORKERS = 4
+SUBMIT_ATTEMPTS = 5
+SUBMIT_TIMEOUT = 60
+RETRY_BASE = 1.0 # seconds, doubled every attempt
+RETRY_CAP = 30.0
+
 
 def main(job_name, job_params, job_version, queue, priority, tags):
     '''
@@ -18,7 +29,51 @@ def main(job_name, job_params, job_version, queue, priority, tags):
     '''
     # submit mozart job
     job_submit_url = "{}{}".format(app.conf['MOZART_REST_URL'], '/job/submit')
-    params = {
+    params = submit_params(job_name, job_params, job_version, queue, priority, tags)
+    print('submitting jobs with params: %s' % json.dumps(params))
+    job_id = submit(requests, job_submit_url, params)
+    print('submitted %s job version: %s job_id: %s' %
+          (job_name, job_version, job_id))
+    return job_id
+
+
+def submit_jobs(jobs, job_version, queue, priority, rate=0, burst=1, workers=SUBMIT_WORKERS, attempts=SUBMIT_ATTEMPTS):
+    '''
+    submits many (job_name, job_params, tags) jobs to mozart, workers at a time over one pooled session and at
+    most rate per second (0 for no limit). transient failures are retried up to attempts times. returns a dict
+    of the index of each job in jobs: {"job_id": id} or {"error": message}, without stopping at a failure
+    '''
+    job_submit_url = "{}{}".format(app.conf['MOZART_REST_URL'], '/job/submit')
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+    bucket = TokenBucket(rate, burst)
+    results = {}
+
+    def submit_one(index):
+        job_name, job_params, tags = jobs[index]
+        params = submit_params(job_name, job_params, job_version, queue, priority, tags)
+        bucket.acquire()
+        try:
+            job_id = submit(session, job_submit_url, params, attempts)
+        except Exception as e:
+            print('job %s not submitted: %s' % (job_name, e))
+            return {"error": str(e)}
+        print('submitted %s job version: %s job_id: %s' % (job_name, job_version, job_id))
+        return {"job_id": job_id}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict((executor.submit(submit_one, index), index) for index in range(len(jobs)))
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    failed = len([result for result in results.values() if "error" in result])
+    print('submitted %s of %s jobs' % (len(jobs) - failed, len(jobs)))
+    return results
+
+
+def submit_params(job_name, job_params, job_version, queue, priority, tags):
+    '''returns the mozart job submission params'''
+    return {
         'queue': queue,
         'priority': int(priority),
         'tags': '[{0}]'.format(parse_job_tags(tags)),
@@ -26,23 +81,60 @@ def main(job_name, job_params, job_version, queue, priority, tags):
         'params': json.dumps(job_params),
         'enable_dedup': True
     }
-    print('submitting jobs with params: %s' % json.dumps(params))
-    r = requests.post(job_submit_url, params=params, verify=False)
+
+
+def submit(session, job_submit_url, params, attempts=SUBMIT_ATTEMPTS):
+    '''posts a job submission, retrying connection errors and 5xx responses with backoff. returns the job id'''
+    for attempt in range(attempts):
+        try:
+            r = session.post(job_submit_url, params=params, verify=False, timeout=SUBMIT_TIMEOUT)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt + 1 >= attempts:
+                raise
+            print('submission failed, retrying: %s' % e)
+        else:
+            if r.status_code < 500 or attempt + 1 >= attempts:
+                break
+            print('submission failed with status %s, retrying' % r.status_code)
+        time.sleep(random.uniform(0, min(RETRY_CAP, RETRY_BASE * (2 ** attempt))))
     if r.status_code != 200:
         print('submission job failed')
         r.raise_for_status()
     result = r.json()
     if 'result' in list(result.keys()) and 'success' in list(result.keys()):
         if result['success'] == True:
-            job_id = result['result']
-            print('submitted %s job version: %s job_id: %s' %
-                  (job_name, job_version, job_id))
-        else:
-            raise Exception('job %s not submitted successfully: %s' %
-                            (job_name, result))
-    else:
-        raise Exception('job %s not submitted successfully: %s' %
-                        (job_name, result))
+            return result['result']
+    raise Exception('job %s not submitted successfully: %s' %
+                    (params['type'], result))
+
+
+class TokenBucket(object):
+    '''
+    Rate limiter for job submissions. acquire() takes a token, blocking until one is available. Tokens
+    refill at rate per second up to capacity, so up to capacity submissions can go out back to back.
+    A rate of 0 disables the limit.
+    '''
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''blocks until a token is available and takes it'''
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
 
 
 def parse_job_tags(tag_string):
@@ -0,0 +1,37 @@
+'''
+Test setup: puts the repo root on the path and, when hysds is not installed,
+registers minimal stand-ins for the parts of it the scripts import.
+'''
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+class Conf(dict):
+    '''celery style config, readable as keys or attributes'''
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+try:
+    import hysds.celery
+except ImportError:
+    hysds = types.ModuleType('hysds')
+    celery = types.ModuleType('hysds.celery')
+    celery.app = types.SimpleNamespace(conf=Conf(GRQ_ES_URL='http://localhost:9200', JOBS_ES_URL='http://localhost:9200',
+                                                 MOZART_REST_URL='http://localhost:8888/api/v0.1',
+                                                 GRQ_UPDATE_URL='http://localhost:8878/api/v0.1/grq/dataset/index',
+                                                 DATASET_PROCESSED_QUEUE='dataset_processed'))
+    dataset_ingest = types.ModuleType('hysds.dataset_ingest')
+    def ingest(*args, **kwargs):
+        raise RuntimeError('hysds is not installed')
+    dataset_ingest.ingest = ingest
+    orchestrator = types.ModuleType('hysds.orchestrator')
+    hysds.celery = celery
+    hysds.dataset_ingest = dataset_ingest
+    hysds.orchestrator = orchestrator
+    sys.modules.update({'hysds': hysds, 'hysds.celery': celery, 'hysds.dataset_ingest': dataset_ingest,
+                        'hysds.orchestrator': orchestrator})
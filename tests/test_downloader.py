@@ -0,0 +1,121 @@
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+import downloader
+
+DATA = bytes(bytearray(range(256))) * 64
+ETAG = '"v1"'
+
+class Handler(BaseHTTPRequestHandler):
+    '''
+    serves DATA with range support, answering the first self.server.failures requests with self.server.status
+    and dropping the connection at byte self.server.drop_at of the next response, if set
+    '''
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers.get('Range'))
+        if server.failures:
+            server.failures -= 1
+            self.send_response(server.status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        first = 0
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range') or '')
+        if match and self.headers.get('If-Range') in (None, ETAG):
+            first = int(match.group(1))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(first, len(DATA) - 1, len(DATA)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(DATA) - first))
+        self.end_headers()
+        if server.drop_at is not None:
+            # drop the connection part way through the body
+            self.wfile.write(DATA[first:server.drop_at])
+            server.drop_at = None
+            self.close_connection = True
+            return
+        self.wfile.write(DATA[first:])
+
+    def do_HEAD(self):
+        self.server.requests.append('HEAD')
+        self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(DATA)))
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    httpd = HTTPServer(('127.0.0.1', 0), Handler)
+    httpd.requests = []
+    httpd.failures = 0
+    httpd.status = 200
+    httpd.drop_at = None
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+def url(httpd):
+    return 'http://127.0.0.1:{}/granule.hdf'.format(httpd.server_address[1])
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(downloader, 'BACKOFF_BASE', 0.001)
+
+def test_client_error_fails_without_retrying(server, tmp_path):
+    server.failures, server.status = 5, 404
+    with pytest.raises(downloader.DownloadError):
+        downloader.download(url(server), str(tmp_path / 'granule.hdf'), attempts=5)
+    assert len(server.requests) == 1
+
+@pytest.mark.parametrize('status', [429, 503])
+def test_throttling_and_server_errors_are_retried(server, tmp_path, status):
+    server.failures, server.status = 2, status
+    path = str(tmp_path / 'granule.hdf')
+    assert downloader.download(url(server), path, attempts=5) == len(DATA)
+    assert len(server.requests) == 3
+    with open(path, 'rb') as fin:
+        assert fin.read() == DATA
+
+def test_small_files_are_not_probed_for_segments(server, tmp_path):
+    session = downloader.get_session(segments={"default": 4})
+    path = str(tmp_path / 'granule.hdf')
+    downloader.download(url(server), path, session, size_mb=len(DATA) / 1024.0 / 1024.0)
+    assert server.requests == [None]
+
+def test_dropped_downloads_resume_from_the_partial_file(server, tmp_path):
+    server.drop_at = 5000
+    path = str(tmp_path / 'granule.hdf')
+    # small reads, so the bytes before the drop reach the partial file
+    session = downloader.get_session(buffer_size=1000)
+    assert downloader.download(url(server), path, session, attempts=3) == len(DATA)
+    assert server.requests == [None, 'bytes=5000-']
+    with open(path, 'rb') as fin:
+        assert fin.read() == DATA
+
+def test_a_size_mismatch_is_fetched_once_more_then_fails(server, tmp_path):
+    path = str(tmp_path / 'granule.hdf')
+    with pytest.raises(downloader.IntegrityError):
+        downloader.download(url(server), path, attempts=10, size_mb=2.5)
+    assert len(server.requests) == 2
+    assert os.listdir(str(tmp_path)) == []
+
+def test_a_failed_download_leaves_no_partial_file(server, tmp_path):
+    server.drop_at = 5000
+    path = str(tmp_path / 'browse.jpg')
+    session = downloader.get_session(buffer_size=1000)
+    with pytest.raises(downloader.DownloadError):
+        downloader.download(url(server), path, session, attempts=1)
+    assert os.listdir(str(tmp_path)) == []
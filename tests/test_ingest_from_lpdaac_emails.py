@@ -0,0 +1,67 @@
+import os
+import tempfile
+
+import boto3
+import pytest
+from moto import mock_aws
+
+# the module sets up the saml-pub aws profile on import
+_aws_config = os.path.join(tempfile.mkdtemp(), 'config')
+with open(_aws_config, 'w') as outf:
+    outf.write('[profile saml-pub]\nregion = us-east-1\naws_access_key_id = testing\naws_secret_access_key = testing\n')
+os.environ['AWS_CONFIG_FILE'] = _aws_config
+
+import ingest_from_lpdaac_emails as emails
+
+BUCKET = 'ava-lpdaac-emails'
+
+def email(order_id):
+    return ('Subject: LP DAAC order {0}\nContent-Type: text/plain\n\n'
+            'ORDERID: {0}\nMEDIATYPE: FtpPull\nHOST: e4ftl01.cr.usgs.gov\nDIR: /PullDir/{0}\n'.format(order_id)).encode('utf-8')
+
+@pytest.fixture
+def s3(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+def listing(s3):
+    '''returns the manifest entries of the emails in the bucket'''
+    return dict((obj['Key'], {"etag": obj['ETag'], "last_modified": obj['LastModified'].isoformat()})
+                for obj in s3.list_objects_v2(Bucket=BUCKET)['Contents'] if obj['Key'] != emails.MANIFEST_KEY)
+
+def test_only_new_and_changed_emails_are_downloaded(s3, tmp_path):
+    for key in ('seen.eml', 'changed.eml', 'zips/new.eml'):
+        s3.put_object(Bucket=BUCKET, Key=key, Body=email('0600000001'))
+    manifest = listing(s3)
+    manifest['changed.eml'] = {"etag": '"stale"', "last_modified": manifest['changed.eml']['last_modified']}
+    del manifest['zips/new.eml']
+    location = 's3://{}/{}'.format(BUCKET, emails.MANIFEST_KEY)
+    emails.save_manifest(location, manifest)
+
+    directory, objects = emails.download_files_from_s3(BUCKET, location, workers=2)
+
+    downloaded = sorted(os.path.relpath(os.path.join(root, name), directory) for root, _, files in os.walk(directory) for name in files)
+    assert downloaded == ['changed.eml', os.path.join('zips', 'new.eml')]
+    # the manifest object itself is never treated as an email
+    assert objects == listing(s3)
+    emails.save_manifest(location, objects)
+    assert emails.load_manifest(s3, location) == objects
+
+def test_a_missing_manifest_downloads_everything(s3, tmp_path):
+    s3.put_object(Bucket=BUCKET, Key='a.eml', Body=email('0600000001'))
+    location = str(tmp_path / 'manifest.json')
+    directory, objects = emails.download_files_from_s3(BUCKET, location)
+    assert os.listdir(directory) == ['a.eml']
+    assert objects == listing(s3)
+
+def test_orders_are_parsed_from_the_downloaded_emails(tmp_path):
+    (tmp_path / 'a.eml').write_bytes(email('0600000001'))
+    (tmp_path / 'b.eml').write_bytes(email('0600000001'))
+    (tmp_path / 'c.eml').write_bytes(email('0600000002'))
+    orders = emails.parse_emails(emails.iter_emails(str(tmp_path)), workers=1)
+    # the same order in two emails is submitted once
+    assert orders == {"0600000001": "ftppull://e4ftl01.cr.usgs.gov/PullDir/0600000001",
+                      "0600000002": "ftppull://e4ftl01.cr.usgs.gov/PullDir/0600000002"}
@@ -0,0 +1,37 @@
+import threading
+
+import pytest
+
+from pipeline import Pipeline, Stage
+
+def test_items_flow_through_every_stage():
+    seen = []
+    lock = threading.Lock()
+    def record(item):
+        with lock:
+            seen.append(item)
+    stages = [
+        Stage('double', lambda n: [n * 2], workers=3, queue_size=4),
+        Stage('odd', lambda batch: [n + 1 for n in batch], batch_size=5, linger=0.01),
+        Stage('sink', record, workers=2),
+    ]
+    pipeline = Pipeline(stages)
+    pipeline.run(range(50))
+    assert sorted(seen) == [n * 2 + 1 for n in range(50)]
+    assert pipeline.source_count == 50
+    assert [(stage.items_in, stage.items_out) for stage in stages] == [(50, 50), (50, 50), (50, 0)]
+
+def test_a_stage_error_stops_the_pipeline_and_is_raised():
+    def fail(n):
+        if n == 7:
+            raise ValueError('bad item')
+        return [n]
+    # the source is endless, so run() only returns if the error aborts it
+    def source():
+        n = 0
+        while True:
+            yield n
+            n += 1
+    pipeline = Pipeline([Stage('fail', fail, workers=2, queue_size=2), Stage('sink', lambda n: [])])
+    with pytest.raises(ValueError):
+        pipeline.run(source())
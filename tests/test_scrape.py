@@ -0,0 +1,120 @@
+import io
+import csv
+import json
+
+import pytest
+
+import scrape
+
+ROWS = [
+    {"id": "AST_L1B_00301012020000000_A", "path": "https://ava.jpl.nasa.gov/ava/A.hdf"},
+    {"id": None, "path": "https://ava.jpl.nasa.gov/ava/B.hdf"},
+    {"id": "AST_L1B_00301012020000000_C", "path": "https://ava.jpl.nasa.gov/ava/C.hdf"},
+    {"id": "AST_L1B_00301012020000000_D", "path": "https://ava.jpl.nasa.gov/ava/D.hdf"},
+]
+
+GRANULES = {
+    "AST_L1B_00301012020000000_A": "2020-01-01T00:00:00Z",
+    "AST_L1B_00301012020000000_D": "2020-01-01T00:10:00Z",
+}
+
+def granule(granule_ur):
+    start = GRANULES[granule_ur]
+    return {"time_start": start, "time_end": start, "producer_granule_id": granule_ur + '.hdf',
+            "polygons": [["10.0 20.0 10.0 21.0 11.0 21.0 11.0 20.0 10.0 20.0"]]}
+
+def test_main_end_to_end(tmp_path, monkeypatch):
+    '''runs a whole scrape with the AVA, CMR, grq and publish calls replaced'''
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(scrape, 'load_context', lambda: {"short_name": "AST_L1B", "start_year": "2020", "end_year": "2020",
+                                                          "cmr_workers": "2"})
+    monkeypatch.setattr(scrape, 'list_ava_rows', lambda url: [dict(row) for row in ROWS])
+    monkeypatch.setattr(scrape, 'query_cmr', lambda session, granule_ur: granule(granule_ur) if granule_ur in GRANULES else None)
+    existing = scrape.gen_prod_id("AST_L1B", GRANULES["AST_L1B_00301012020000000_D"], GRANULES["AST_L1B_00301012020000000_D"])
+    monkeypatch.setattr(scrape, 'exists_bulk', lambda uids, idx: set(uids) & {existing})
+    published = []
+    monkeypatch.setattr(scrape, 'ingest', lambda uid, *args: published.append(uid))
+
+    scrape.main()
+
+    assert published == [scrape.gen_prod_id("AST_L1B", GRANULES["AST_L1B_00301012020000000_A"], GRANULES["AST_L1B_00301012020000000_A"])]
+    with open(str(tmp_path / scrape.REPORT_FILE)) as fin:
+        report = json.load(fin)
+    assert (report["total_granules"], report["ingested_granules"], report["non_ingested_granules"]) == (4, 1, 2)
+    with open(str(tmp_path / scrape.CHECKPOINT_FILE)) as fin:
+        checkpoint = json.load(fin)
+    # the year was fully listed, so the checkpoint has moved past it
+    assert (checkpoint["year"], checkpoint["offset"], checkpoint["total_granules"]) == (2021, 0, 4)
+    with open(str(tmp_path / scrape.MISSING_CSV)) as fin:
+        missing = list(csv.DictReader(fin))
+    assert [row["missing_lp_daac_id_products"] for row in missing] == ["B.hdf"]
+
+def item(year, offset, id='G'):
+    return {"year": year, "offset": offset, "row": {"id": id, "path": "https://ava.jpl.nasa.gov/ava/{}_{}.hdf".format(year, offset)}}
+
+def progress(tmp_path, interval=100):
+    checkpoint = {"year": 2000, "offset": 0, "total_granules": 0, "ingested_granules": 0, "non_ingested_granules": 0}
+    mp_csv = io.StringIO()
+    return scrape.ScrapeProgress(checkpoint, str(tmp_path / 'checkpoint.json'), interval, mp_csv, csv.DictWriter(mp_csv, fieldnames=["missing_lp_daac_id_products", "ava_product_url"]))
+
+def test_checkpoint_only_advances_over_contiguous_rows(tmp_path):
+    tracker = progress(tmp_path)
+    tracker.done(item(2000, 1), 'ingested')
+    tracker.done(item(2000, 2), 'skipped')
+    # row 0 is still in flight
+    assert tracker.checkpoint["offset"] == 0
+    assert tracker.checkpoint["total_granules"] == 0
+    tracker.done(item(2000, 0), 'non_ingested')
+    assert (tracker.checkpoint["year"], tracker.checkpoint["offset"]) == (2000, 3)
+    assert (tracker.checkpoint["total_granules"], tracker.checkpoint["ingested_granules"], tracker.checkpoint["non_ingested_granules"]) == (3, 1, 1)
+
+def test_checkpoint_moves_to_the_next_year_once_listed_and_done(tmp_path):
+    tracker = progress(tmp_path)
+    tracker.done(item(2000, 0), 'ingested')
+    tracker.done(item(2001, 0), 'ingested')
+    # 2000 may still have rows coming until its listing is complete
+    assert (tracker.checkpoint["year"], tracker.checkpoint["offset"]) == (2000, 1)
+    tracker.year_listed(2000, 1)
+    assert (tracker.checkpoint["year"], tracker.checkpoint["offset"]) == (2001, 1)
+
+def test_checkpoint_is_saved_every_interval_rows(tmp_path):
+    tracker = progress(tmp_path, interval=2)
+    tracker.done(item(2000, 0), 'ingested')
+    assert scrape.load_checkpoint(tracker.path) is None
+    tracker.done(item(2000, 1), 'ingested')
+    assert scrape.load_checkpoint(tracker.path)["offset"] == 2
+
+def test_iter_json_array_decodes_elements_split_across_chunks():
+    text = ' [{"id": "a", "path": "x[1]"}, {"id": null},\n 12, "s,]", [1, 2]]'
+    for size in (1, 3, 7, len(text)):
+        chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        assert list(scrape.iter_json_array(chunks)) == [{"id": "a", "path": "x[1]"}, {"id": None}, 12, "s,]", [1, 2]]
+
+def test_iter_json_array_rejects_a_truncated_array():
+    with pytest.raises(ValueError):
+        list(scrape.iter_json_array(['[{"id": "a"}, {"id"']))
+
+def test_fan_out_gives_each_shard_its_own_index_and_an_open_ended_last_range(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(scrape, 'load_context', lambda: {"short_name": "AST_L1B", "start_year": "2020", "end_year": "2020",
+                                                          "fan_out": "true", "year_splits": "3", "ingested_index": "/data/ingested.db",
+                                                          "ingested_index_mode": "seed"})
+    monkeypatch.setattr(scrape, 'list_ava_rows', lambda url: [dict(row) for row in ROWS * 3])
+    def no_index(ctx, shortname):
+        raise AssertionError('the fan out job must not open the ingested index')
+    monkeypatch.setattr(scrape, 'load_ingested_index', no_index)
+    submitted = []
+    monkeypatch.setattr(scrape, 'submit_job', lambda name, params, *args: submitted.append(params))
+
+    scrape.main()
+
+    assert [(p.get("row_start"), p.get("row_end")) for p in submitted] == [(0, 4), (4, 8), (8, None)]
+    assert len(set(p["ingested_index"] for p in submitted)) == 3
+    assert all(p["ingested_index"].startswith("/data/ingested.db.") and p["ingested_index_mode"] == "seed" for p in submitted)
+
+def test_cmr_entries_without_a_location_count_as_missing(tmp_path):
+    tracker = progress(tmp_path)
+    entry = granule("AST_L1B_00301012020000000_A")
+    entry["polygons"] = []
+    assert scrape.attach_products([(item(2000, 0), entry)], "AST_L1B", tracker) == []
+    assert (tracker.checkpoint["total_granules"], tracker.checkpoint["non_ingested_granules"]) == (1, 1)
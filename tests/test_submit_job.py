@@ -0,0 +1,80 @@
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+try:
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from urlparse import urlparse, parse_qs
+
+import pytest
+
+import submit_job
+
+class MozartHandler(BaseHTTPRequestHandler):
+    '''
+    stands in for the mozart job submission api. job-flaky fails once with a 503,
+    job-rejected is always a 400 and every other job is accepted
+    '''
+    def do_POST(self):
+        params = parse_qs(urlparse(self.path).query)
+        job_name = params['type'][0].split(':')[0]
+        server = self.server
+        with server.lock:
+            server.attempts[job_name] = server.attempts.get(job_name, 0) + 1
+            attempt = server.attempts[job_name]
+        if job_name == 'job-rejected':
+            self.reply(400, {"success": False, "message": "unknown job type"})
+        elif job_name == 'job-flaky' and attempt == 1:
+            self.reply(503, {"success": False})
+        else:
+            self.reply(200, {"success": True, "result": 'id-{}'.format(job_name)})
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def mozart(monkeypatch):
+    httpd = HTTPServer(('127.0.0.1', 0), MozartHandler)
+    httpd.lock = threading.Lock()
+    httpd.attempts = {}
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    monkeypatch.setitem(submit_job.app.conf, 'MOZART_REST_URL', 'http://127.0.0.1:{}/api/v0.1'.format(httpd.server_address[1]))
+    monkeypatch.setattr(submit_job, 'RETRY_BASE', 0.001)
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_submit_jobs_retries_and_reports_partial_failure(mozart):
+    jobs = [('job-ok', {"n": 1}, 'tag-a'), ('job-flaky', {"n": 2}, 'tag-b'), ('job-rejected', {"n": 3}, None)]
+    results = submit_job.submit_jobs(jobs, 'master', 'factotum-job_worker-small', 5, workers=2, attempts=3)
+    assert results[0] == {"job_id": "id-job-ok"}
+    assert results[1] == {"job_id": "id-job-flaky"}
+    assert "error" in results[2]
+    # the 503 is retried, the 400 is not
+    assert mozart.attempts == {"job-ok": 1, "job-flaky": 2, "job-rejected": 1}
+
+def test_submit_gives_up_after_attempts(mozart):
+    url = submit_job.app.conf['MOZART_REST_URL'] + '/job/submit'
+    params = submit_job.submit_params('job-flaky', {}, 'master', 'queue', 5, '')
+    with pytest.raises(Exception):
+        submit_job.submit(submit_job.requests, url, params, attempts=1)
+    assert mozart.attempts == {"job-flaky": 1}
+
+def test_token_bucket_limits_the_rate():
+    bucket = submit_job.TokenBucket(50, 2)
+    start = time.time()
+    for _ in range(7):
+        bucket.acquire()
+    # the first 2 go out at once, the other 5 at 50 per second
+    assert time.time() - start >= 0.09